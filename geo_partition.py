@@ -0,0 +1,178 @@
+# geo_partition.py (main.py 용 지역 분할 차량 위치 인덱스)
+# - 전체 차량을 하나의 "vehicles" GEO 키에 넣는 대신 geohash 앞 N자리 셀마다 "vehicles:{cell}" 키로 나눔
+# - 반경 검색은 검색 원이 걸치는 셀 키들만 확인하므로 전국 차량 수가 늘어도 지역 검색 비용은 그대로
+# - 셀 키는 crc32 로 여러 Redis 인스턴스에 나눠 둘 수 있음 (node_id -> 셀 레지스트리는 기본 Redis 에 둠)
+# precision=0 이면 기존처럼 단일 "vehicles" 키를 사용합니다.
+import math
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+METERS_PER_DEG_LAT = 111320.0
+
+VEHICLES_KEY = "vehicles"
+VEHICLE_CELLS_KEY = "vehicle_cells"  # node_id -> 현재 셀 키 (Redis Hash)
+
+
+def geohash_encode(lat: float, lon: float, precision: int) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coord = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_BASE32[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+
+def cell_size_deg(precision: int) -> Tuple[float, float]:
+    """geohash 셀 한 칸의 (위도, 경도) 크기(도)."""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def covering_cells(lat: float, lon: float, radius_m: float, precision: int) -> List[str]:
+    """(lat, lon) 중심 radius_m 원의 외접 사각형에 걸치는 셀 목록 (보통 1~4개)."""
+    lat_deg, lon_deg = cell_size_deg(precision)
+    dlat = radius_m / METERS_PER_DEG_LAT
+    dlon = dlat / max(math.cos(math.radians(min(89.0, abs(lat) + dlat))), 1e-6)
+    row_min = int(math.floor((max(-90.0, lat - dlat) + 90) / lat_deg))
+    row_max = int(math.floor((min(90.0, lat + dlat) + 90) / lat_deg))
+    col_min = int(math.floor((lon - dlon + 180) / lon_deg))
+    col_max = int(math.floor((lon + dlon + 180) / lon_deg))
+    rows = int(round(180.0 / lat_deg))
+    cols = int(round(360.0 / lon_deg))
+    cells = []
+    for row in range(row_min, min(row_max, rows - 1) + 1):
+        for col in range(col_min, col_max + 1):
+            centre_lat = -90 + (row + 0.5) * lat_deg
+            centre_lon = -180 + ((col % cols) + 0.5) * lon_deg  # 날짜변경선에서 경도 순환
+            cell = geohash_encode(centre_lat, centre_lon, precision)
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+class GeoPartitionIndex:
+    """셀 키로 나눈 GEO 인덱스. 검색 결과 형식은 redis-py geosearch 와 같습니다."""
+
+    def __init__(self, primary, shards: Sequence = (), precision: int = 0,
+                 execute: Optional[Callable[..., Awaitable]] = None):
+        self.primary = primary
+        self.shards = list(shards) or [primary]
+        self.precision = precision
+        self.execute = execute or (lambda pipe: pipe.execute())
+
+    @property
+    def partitioned(self) -> bool:
+        return self.precision > 0
+
+    @property
+    def sharded(self) -> bool:
+        """셀 키가 기본 Redis 밖에 있으면 Lua 스크립트 한 번으로 처리할 수 없음."""
+        return self.shards != [self.primary]
+
+    def key_for(self, lat: float, lon: float) -> str:
+        if not self.partitioned:
+            return VEHICLES_KEY
+        return f"{VEHICLES_KEY}:{geohash_encode(lat, lon, self.precision)}"
+
+    def keys_near(self, lat: float, lon: float, radius_m: float) -> List[str]:
+        if not self.partitioned:
+            return [VEHICLES_KEY]
+        return [f"{VEHICLES_KEY}:{cell}" for cell in covering_cells(lat, lon, radius_m, self.precision)]
+
+    def client_for(self, key: str):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+
+    def _by_client(self, keys):
+        grouped = {}
+        for key in keys:
+            client = self.client_for(key)
+            grouped.setdefault(id(client), (client, []))[1].append(key)
+        return grouped.values()
+
+    async def current_keys(self, node_ids: Sequence[str]) -> Dict[str, str]:
+        if not self.partitioned:
+            return {n: VEHICLES_KEY for n in node_ids}
+        cells = await self.primary.hmget(VEHICLE_CELLS_KEY, *node_ids)
+        return {n: key for n, key in zip(node_ids, cells) if key}
+
+    async def add(self, node_id: str, lat: float, lon: float):
+        key = self.key_for(lat, lon)
+        await self.client_for(key).geoadd(key, (lon, lat, node_id))
+        if not self.partitioned:
+            return
+        # 차량이 다른 워커로 재접속해 셀을 옮겼을 수 있으므로 이전 셀은 항상 레지스트리에서 읽음.
+        # 새 셀에 먼저 넣고 HGET+HSET 을 MULTI 로 한 번에 바꿔, 동시에 갱신하는 워커끼리도
+        # 각자 자기가 덮어쓴 셀만 지우게 함 (고아 항목 방지)
+        pipe = self.primary.pipeline(transaction=True)
+        pipe.hget(VEHICLE_CELLS_KEY, node_id)
+        pipe.hset(VEHICLE_CELLS_KEY, node_id, key)
+        previous, _ = await self.execute(pipe)
+        if previous and previous != key:
+            await self.client_for(previous).zrem(previous, node_id)
+
+    async def search(self, lat: float, lon: float, radius_m: float, withcoord: bool = False) -> List:
+        results = []
+        for client, keys in self._by_client(self.keys_near(lat, lon, radius_m)):
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.geosearch(key, longitude=lon, latitude=lat, radius=radius_m, unit="m", withcoord=withcoord)
+            for found in await self.execute(pipe):
+                results.extend(found)
+        return results
+
+    async def positions(self, node_ids: Sequence[str]) -> Dict[str, Tuple[float, float]]:
+        """node_id -> (lat, lon). 위치가 없는 노드는 빠집니다."""
+        if not node_ids:
+            return {}
+        by_key: Dict[str, List[str]] = {}
+        for node_id, key in (await self.current_keys(node_ids)).items():
+            by_key.setdefault(key, []).append(node_id)
+        return await self._geopos(by_key)
+
+    async def all_positions(self) -> Dict[str, Tuple[float, float]]:
+        if not self.partitioned:
+            node_ids = await self.primary.zrange(VEHICLES_KEY, 0, -1)
+            return await self._geopos({VEHICLES_KEY: node_ids}) if node_ids else {}
+        by_key: Dict[str, List[str]] = {}
+        for node_id, key in (await self.primary.hgetall(VEHICLE_CELLS_KEY)).items():
+            by_key.setdefault(key, []).append(node_id)
+        return await self._geopos(by_key)
+
+    async def _geopos(self, by_key: Dict[str, List[str]]) -> Dict[str, Tuple[float, float]]:
+        found = {}
+        for client, keys in self._by_client(by_key):
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.geopos(key, *by_key[key])
+            for key, coords in zip(keys, await self.execute(pipe)):
+                found.update({n: (c[1], c[0]) for n, c in zip(by_key[key], coords) if c})
+        return found
+
+    async def remove(self, node_ids: Sequence[str]):
+        if not node_ids:
+            return
+        by_key: Dict[str, List[str]] = {}
+        for node_id, key in (await self.current_keys(node_ids)).items():
+            by_key.setdefault(key, []).append(node_id)
+        for client, keys in self._by_client(by_key):
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.zrem(key, *by_key[key])
+            await self.execute(pipe)
+        if self.partitioned:
+            await self.primary.hdel(VEHICLE_CELLS_KEY, *node_ids)
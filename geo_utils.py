@@ -0,0 +1,12 @@
+# geo_utils.py (서버/클라이언트/HoloLens 브리지가 함께 쓰는 거리 계산)
+# - 다른 모듈을 가져오지 않으므로 어느 프로세스에서든 가볍게 import 가능
+import math
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1, math.sqrt(a)))
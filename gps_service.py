@@ -20,6 +20,8 @@ import math
 # WebSocket (기존)
 import websockets
 
+from geo_utils import haversine_m
+
 # 맵 매칭 (신규)
 try:
     from map_matcher import MapMatcher
@@ -42,6 +44,10 @@ OSM_FILE_PATH = "your_map.osm"
 INCIDENT_FILE_PATH = "incidents.json"  # ⭐️ 이 파일을 읽습니다
 INCIDENT_SYNC_INTERVAL_SECONDS = 60  # 1분 (60초) 설정
 
+# 임시 핀 병합: 이 거리(m) 안의 핀은 하나로 합치고, 최근 보낸 핀과 가까우면 다시 보내지 않음
+TEMP_PIN_DEDUP_M = 30.0
+TEMP_PIN_DEDUP_SECONDS = 10.0
+
 LISTENER_BROADCAST_PORT = 9999  # ⭐️ [추가 2/4] tts.py가 듣는 포트 (gps_sender.py와 동일)
 
 # 시뮬레이션 설정
@@ -71,6 +77,8 @@ except Exception:
     map_matcher = TempMapMatcher()
 
 known_pin_ids = set()
+recent_temp_pins = []  # (sent_at, lat, lon, level) — /add_temp_pins 공간 중복 제거용
+recent_temp_pins_lock = threading.Lock()
 
 # --- 3. Flask 서버 및 Dash 앱 초기화 ---
 app = Flask(__name__)
@@ -397,6 +405,37 @@ def generate_gps_route(start_pos, end_pos, steps):
     return route
 
 
+def send_temp_pin(lat: float, lon: float, level: int) -> str:
+    """Unity로 ADD_PINPOINT 웹소켓 메시지를 보내고 핀 ID를 반환합니다."""
+    if level == 1:
+        title = "주의"
+        color_type = 1
+    elif level >= 2:
+        title = "경고"
+        color_type = 2
+    else:
+        title = "알림"
+        color_type = 0
+
+    pin_id = f"TEMP_PIN_{str(uuid.uuid4())[:8]}"
+    label = f"[경고: {level}] {title}"
+
+    message = json.dumps({
+        "type": "ADD_PINPOINT",
+        "payload": {
+            "id": pin_id,
+            "latitude": lat,
+            "longitude": lon,
+            "label": label,
+            "type": 99,  # 임시 핀 타입을 99로 지정
+            "title": title,
+            "color_type": color_type
+        }
+    })
+    send_ws(message)
+    return pin_id
+
+
 @app.route("/add_temp_pin", methods=["POST"])
 def add_temp_pin_http():
     """
@@ -413,33 +452,7 @@ def add_temp_pin_http():
         lon = float(data.get("longitude"))
         level = int(data.get("level", 0))  # p2p_client가 보낸 경고 레벨
 
-        if level == 1:
-            title = "주의"
-            color_type = 1
-        elif level >= 2:
-            title = "경고"
-            color_type = 2
-        else:
-            title = "알림"
-            color_type = 0
-
-        pin_id = f"TEMP_PIN_{str(uuid.uuid4())[:8]}"
-        label = f"[경고: {level}] {title}"
-
-        message = json.dumps({
-            "type": "ADD_PINPOINT",
-            "payload": {
-                "id": pin_id,
-                "latitude": lat,
-                "longitude": lon,
-                "label": label,
-                "type": 99,  # 임시 핀 타입을 99로 지정
-                "title": title,
-                "color_type": color_type
-            }
-        })
-
-        send_ws(message)
+        pin_id = send_temp_pin(lat, lon, level)
         print(f"✨ [HTTP] 임시 핀 즉시 전송: {pin_id}")
         return "Temp Pin Sent", 200
 
@@ -448,6 +461,55 @@ def add_temp_pin_http():
         return str(e), 500
 
 
+def merge_temp_pins(pins):
+    """TEMP_PIN_DEDUP_M 안의 핀을 하나로 합치고(가장 높은 레벨 유지),
+    최근 TEMP_PIN_DEDUP_SECONDS 안에 같은 레벨 이상으로 보낸 핀 근처면 버립니다."""
+    merged = []
+    for lat, lon, level in pins:
+        for pin in merged:
+            if haversine_m(lat, lon, pin[0], pin[1]) <= TEMP_PIN_DEDUP_M:
+                pin[2] = max(pin[2], level)
+                break
+        else:
+            merged.append([lat, lon, level])
+
+    now = time.time()
+    fresh = []
+    with recent_temp_pins_lock:
+        recent_temp_pins[:] = [p for p in recent_temp_pins if now - p[0] < TEMP_PIN_DEDUP_SECONDS]
+        for lat, lon, level in merged:
+            if any(haversine_m(lat, lon, p[1], p[2]) <= TEMP_PIN_DEDUP_M and p[3] >= level
+                   for p in recent_temp_pins):
+                continue
+            recent_temp_pins.append((now, lat, lon, level))
+            fresh.append((lat, lon, level))
+    return fresh
+
+
+@app.route("/add_temp_pins", methods=["POST"])
+def add_temp_pins_http():
+    """
+    p2p_client.py가 짧은 시간 동안 모은 경고 핀 목록을 한 번에 보냅니다.
+    {"pins": [{"latitude": .., "longitude": .., "level": ..}, ...]}
+    가까운 핀은 하나로 합쳐서 Unity로 전송합니다.
+    """
+    try:
+        data = request.json
+        if not data or not isinstance(data.get("pins"), list):
+            return "Invalid data", 400
+
+        pins = [(float(p["latitude"]), float(p["longitude"]), int(p.get("level", 0)))
+                for p in data["pins"] if "latitude" in p and "longitude" in p]
+        fresh = merge_temp_pins(pins)
+        pin_ids = [send_temp_pin(lat, lon, level) for lat, lon, level in fresh]
+        print(f"✨ [HTTP] 임시 핀 일괄 전송: 요청 {len(pins)}개 -> 전송 {len(pin_ids)}개")
+        return {"received": len(pins), "sent": len(pin_ids), "pin_ids": pin_ids}, 200
+
+    except Exception as e:
+        print(f"⚠️ /add_temp_pins 오류: {e}")
+        return str(e), 500
+
+
 def run_simulation_thread():
     global latest_gps_position, CURRENT_MODE
 
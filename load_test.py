@@ -0,0 +1,312 @@
+# load_test.py (main.py 부하 테스트 / 지연 벤치마크)
+# 가상 차량 수천 대가 경계 영역 안에서 합성 GPS 궤적을 보내며 다음을 측정합니다.
+#   - GPS -> group_update 지연 (스냅샷 속 내 좌표로 어떤 GPS 가 만든 응답인지 찾아 그 송신 시각과 비교)
+#   - GPS -> group_delta 지연 상한 (델타에는 내 좌표가 없으므로 아직 응답을 못 받은 가장 오래된 GPS 기준)
+#   - p2p_relay 왕복 지연 p50/p99 (상대 차량이 그대로 되돌려 보냄)
+#   - GPS 1건당 Redis 명령 수 (INFO stats 의 total_commands_processed 차이)
+#   - 연결당 서버 CPU (/proc/<pid>/stat)
+#
+# 예) python load_test.py --vehicles 2000 --duration 60 --spawn-server --backend memory
+#     python load_test.py --uri ws://localhost:8080/ws/ --vehicles 500 --server-pid 1234 --redis-url redis://localhost
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+import websockets
+
+import message_codec
+from relay_metrics import percentile
+
+# 기본 시뮬레이션 영역 (gps_service.py 의 INITIAL_CENTER 주변)
+DEFAULT_CENTER = (37.2959, 126.8368)
+METERS_PER_DEG_LAT = 111320.0
+FIX_MATCH_TOLERANCE_M = 1.0  # Redis GEO 저장 오차(수십 cm)를 감안한 좌표 일치 허용 거리
+PENDING_FIXES_MAX = 1000
+
+
+class Samples:
+    def __init__(self):
+        self.values: List[float] = []
+
+    def add(self, ms: float):
+        self.values.append(ms)
+
+    def percentile(self, p: float) -> float:
+        return percentile(sorted(self.values), p)
+
+    def summary(self) -> Dict:
+        return {"n": len(self.values), "p50_ms": round(self.percentile(0.5), 2),
+                "p99_ms": round(self.percentile(0.99), 2), "max_ms": round(max(self.values, default=0.0), 2)}
+
+
+class LoadStats:
+    def __init__(self):
+        self.fixes_sent = 0
+        self.relays_sent = 0
+        self.connected = 0
+        self.rejected = 0  # 서버 접속 속도 제한(retry_later)으로 거절된 연결
+        self.errors = 0
+        self.messages_received: Dict[str, int] = {}
+        self.group_latency = Samples()
+        self.delta_latency = Samples()
+        self.unmatched_updates = 0
+        self.relay_rtt = Samples()
+
+
+class SyntheticTrace:
+    """영역 안에서 속도/방향이 천천히 바뀌는 랜덤 워크. 경계에 닿으면 반사합니다."""
+
+    def __init__(self, center, half_size_m: float, speed_mps: float):
+        self.center = center
+        self.half_size_m = half_size_m
+        self.x = random.uniform(-half_size_m, half_size_m)
+        self.y = random.uniform(-half_size_m, half_size_m)
+        self.heading = random.uniform(0, 2 * math.pi)
+        self.speed = random.uniform(0, speed_mps)  # 일부는 정지 차량
+
+    def step(self, dt: float):
+        self.heading += random.gauss(0, 0.2)
+        self.x += math.cos(self.heading) * self.speed * dt
+        self.y += math.sin(self.heading) * self.speed * dt
+        if abs(self.x) > self.half_size_m:
+            self.x = math.copysign(self.half_size_m, self.x)
+            self.heading = math.pi - self.heading
+        if abs(self.y) > self.half_size_m:
+            self.y = math.copysign(self.half_size_m, self.y)
+            self.heading = -self.heading
+
+    def position(self):
+        lat = self.center[0] + self.y / METERS_PER_DEG_LAT
+        lon = self.center[1] + self.x / (METERS_PER_DEG_LAT * math.cos(math.radians(self.center[0])))
+        return lat, lon
+
+
+async def run_vehicle(index: int, args, stats: LoadStats, stop_at: float):
+    node_id = f"load-{index:05d}"
+    uri = f"{args.uri}{node_id}"
+    encoding = message_codec.negotiate(args.encoding)  # 로컬에 msgpack 이 없으면 json
+    if encoding != message_codec.ENCODING_JSON:
+        uri += f"?encoding={encoding}"
+    trace = SyntheticTrace(DEFAULT_CENTER, args.area_m / 2, args.speed)
+    state = {"encoding": message_codec.ENCODING_JSON, "peers": set()}
+    pending_fixes: deque = deque(maxlen=PENDING_FIXES_MAX)  # 응답을 아직 확인하지 못한 (송신 시각, lat, lon)
+
+    def match_fix(location) -> Optional[float]:
+        """group_update 속 내 좌표와 가장 가까운 미응답 GPS 의 송신 시각. 그 이전 GPS 는 처리된 것으로 보고 버림."""
+        best, best_m = None, FIX_MATCH_TOLERANCE_M
+        for i, (_, lat, lon) in enumerate(pending_fixes):
+            dist = math.hypot((lat - location[0]) * METERS_PER_DEG_LAT,
+                              (lon - location[1]) * METERS_PER_DEG_LAT * math.cos(math.radians(lat)))
+            # 정지 차량처럼 같은 좌표가 여러 번이면 가장 오래된 것 (지연을 낮춰 잡지 않도록)
+            if dist < best_m or (best is None and dist <= best_m):
+                best, best_m = i, dist
+        if best is None:
+            return None
+        sent_at = pending_fixes[best][0]
+        for _ in range(best + 1):
+            pending_fixes.popleft()
+        return sent_at
+
+    try:
+        async with websockets.connect(uri, max_queue=None) as websocket:
+            async def send(message: Dict):
+                await websocket.send(message_codec.encode(message, state["encoding"]))
+
+            async def receiver():
+                async for raw in websocket:
+                    data = message_codec.decode(raw)
+                    msg_type = data.get("type", "?")
+                    stats.messages_received[msg_type] = stats.messages_received.get(msg_type, 0) + 1
+                    if msg_type == "hello":
+                        # 수락된 연결만 집계 (retry_later 로 거절되면 hello 가 오지 않음)
+                        stats.connected += 1
+                        state["encoding"] = data.get("encoding", message_codec.ENCODING_JSON)
+                    elif msg_type == "retry_later":
+                        state["rejected"] = True
+                        stats.rejected += 1
+                    elif msg_type == "group_update":
+                        own = next((m for m in data.get("data", []) if m["node_id"] == node_id), None)
+                        sent_at = match_fix(own["location"]) if own else None
+                        if sent_at is not None:
+                            stats.group_latency.add((time.perf_counter() - sent_at) * 1000)
+                        else:
+                            stats.unmatched_updates += 1
+                        state["peers"] = {m["node_id"] for m in data.get("data", []) if m["node_id"] != node_id}
+                    elif msg_type == "group_delta":
+                        if pending_fixes:
+                            stats.delta_latency.add((time.perf_counter() - pending_fixes[0][0]) * 1000)
+                        state["peers"].update(m["node_id"] for m in data.get("joined", []))
+                        state["peers"].difference_update(data.get("left", []))
+                    elif msg_type == "p2p_message":
+                        content = data.get("content")
+                        if not isinstance(content, str) or not content.startswith("load_ping:"):
+                            continue
+                        _, kind, origin, sent_at = content.split(":", 3)
+                        if kind == "req":
+                            await send({"type": "p2p_relay", "target_id": data["from_id"],
+                                        "content": f"load_ping:ack:{origin}:{sent_at}"})
+                        elif origin == node_id:
+                            stats.relay_rtt.add((time.perf_counter() - float(sent_at)) * 1000)
+
+            async def sender():
+                interval = 1.0 / args.rate
+                next_relay = time.perf_counter() + random.uniform(0, args.relay_interval)
+                while time.perf_counter() < stop_at:
+                    trace.step(interval)
+                    lat, lon = trace.position()
+                    pending_fixes.append((time.perf_counter(), lat, lon))
+                    await send({"latitude": lat, "longitude": lon})
+                    stats.fixes_sent += 1
+                    if args.relay_interval > 0 and state["peers"] and time.perf_counter() >= next_relay:
+                        target = random.choice(sorted(state["peers"]))
+                        await send({"type": "p2p_relay", "target_id": target,
+                                    "content": f"load_ping:req:{node_id}:{time.perf_counter()}"})
+                        stats.relays_sent += 1
+                        next_relay = time.perf_counter() + args.relay_interval
+                    await asyncio.sleep(interval * random.uniform(0.9, 1.1))
+
+            receive_task = asyncio.create_task(receiver())
+            await sender()
+            await asyncio.sleep(args.drain)
+            receive_task.cancel()
+    except Exception as e:
+        if state.get("rejected"):
+            return
+        stats.errors += 1
+        if args.verbose:
+            print(f"⚠️ [{node_id}] 오류: {e}")
+
+
+def read_cpu_seconds(pid: Optional[int]) -> Optional[float]:
+    """/proc/<pid>/stat 의 utime+stime. 멀티 워커면 각 워커 PID 를 따로 측정해야 합니다."""
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = int(fields[11]) + int(fields[12])  # utime, stime
+        return ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+async def read_redis_commands(redis_url: Optional[str]) -> Optional[int]:
+    if not redis_url:
+        return None
+    try:
+        import redis.asyncio as aioredis
+        client = aioredis.from_url(redis_url)
+        info = await client.info("stats")
+        await client.aclose()
+        return int(info["total_commands_processed"])
+    except Exception as e:
+        print(f"⚠️ Redis 통계를 읽을 수 없습니다: {e}")
+        return None
+
+
+def spawn_server(args, unset_env: Iterable[str] = ()) -> subprocess.Popen:
+    """벤치마크용 main.py 를 띄웁니다. replay_capture 도 이 함수를 씁니다."""
+    env = dict(os.environ, GROUPING_BACKEND=args.backend, SERVER_PORT=str(args.port))
+    for name in unset_env:
+        env.pop(name, None)
+    # 이전 실행의 웜 재시작 상태를 이어받지 않고, 빠른 램프업이 접속 속도 제한에 걸리지 않게 함
+    env.update(WARM_SNAPSHOT_PATH="", WARM_RESTART_GRACE_S="0", ADMISSION_RATE="0")
+    if args.redis_url:
+        env["REDIS_URL"] = args.redis_url
+    process = subprocess.Popen([sys.executable, "main.py"], env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    time.sleep(args.server_startup)
+    return process
+
+
+async def main(args):
+    server = spawn_server(args) if args.spawn_server else None
+    server_pid = server.pid if server else args.server_pid
+    try:
+        stats = LoadStats()
+        cpu_before = read_cpu_seconds(server_pid)
+        redis_before = await read_redis_commands(args.redis_url)
+        started = time.perf_counter()
+        stop_at = started + args.ramp + args.duration
+
+        tasks = []
+        for i in range(args.vehicles):
+            tasks.append(asyncio.create_task(run_vehicle(i, args, stats, stop_at)))
+            if args.ramp > 0:
+                await asyncio.sleep(args.ramp / args.vehicles)
+        print(f"🚗 가상 차량 {args.vehicles}대 출발, {args.duration}초 동안 측정합니다...")
+        await asyncio.gather(*tasks)
+
+        elapsed = time.perf_counter() - started
+        cpu_after = read_cpu_seconds(server_pid)
+        redis_after = await read_redis_commands(args.redis_url)
+
+        report = {
+            "vehicles": args.vehicles,
+            "connected": stats.connected,
+            "rejected": stats.rejected,
+            "errors": stats.errors,
+            "elapsed_s": round(elapsed, 2),
+            "fixes_sent": stats.fixes_sent,
+            "fixes_per_s": round(stats.fixes_sent / elapsed, 1),
+            "relays_sent": stats.relays_sent,
+            "messages_received": stats.messages_received,
+            "gps_to_group_update": stats.group_latency.summary(),
+            "gps_to_group_update_unmatched": stats.unmatched_updates,
+            "gps_to_group_delta_upper_bound": stats.delta_latency.summary(),
+            "relay_rtt": stats.relay_rtt.summary(),
+        }
+        if redis_before is not None and redis_after is not None and stats.fixes_sent:
+            report["redis_ops_per_fix"] = round((redis_after - redis_before) / stats.fixes_sent, 2)
+        if cpu_before is not None and cpu_after is not None and stats.connected:
+            cpu_s = cpu_after - cpu_before
+            report["server_cpu_s"] = round(cpu_s, 2)
+            report["server_cpu_ms_per_conn_per_s"] = round(cpu_s * 1000 / stats.connected / elapsed, 3)
+
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            print(f"📄 결과를 {args.output} 에 저장했습니다.")
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="main.py fleet load generator / latency benchmark")
+    parser.add_argument("--uri", default="ws://localhost:8080/ws/", help="main.py 웹소켓 주소 (node_id 앞부분까지)")
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=30.0, help="측정 시간(초)")
+    parser.add_argument("--ramp", type=float, default=10.0, help="전체 차량이 접속하는 데 걸리는 시간(초)")
+    parser.add_argument("--drain", type=float, default=2.0, help="송신 종료 후 응답을 기다리는 시간(초)")
+    parser.add_argument("--rate", type=float, default=1.0, help="차량당 GPS 송신 주기(Hz)")
+    parser.add_argument("--area-m", type=float, default=5000.0, help="시뮬레이션 영역 한 변 길이(m)")
+    parser.add_argument("--speed", type=float, default=15.0, help="차량 최대 속도(m/s)")
+    parser.add_argument("--relay-interval", type=float, default=5.0, help="차량당 릴레이 핑 간격(초), 0이면 끔")
+    parser.add_argument("--encoding", default=message_codec.ENCODING_JSON,
+                        choices=message_codec.supported_encodings())
+    parser.add_argument("--redis-url", help="Redis 명령 수 측정용 (memory 백엔드면 생략)")
+    parser.add_argument("--server-pid", type=int, help="CPU 측정할 main.py 프로세스 PID")
+    parser.add_argument("--spawn-server", action="store_true", help="main.py 를 직접 띄워서 측정")
+    parser.add_argument("--backend", default="memory", choices=["memory", "redis"], help="--spawn-server 시 그룹핑 백엔드")
+    parser.add_argument("--port", type=int, default=8080, help="--spawn-server 시 서버 포트")
+    parser.add_argument("--server-startup", type=float, default=3.0, help="--spawn-server 후 대기 시간(초)")
+    parser.add_argument("--output", help="결과 JSON 저장 경로")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.spawn_server:
+        args.uri = f"ws://localhost:{args.port}/ws/"
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("\n부하 테스트를 중단합니다.")
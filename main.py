@@ -1,106 +1,1575 @@
 import asyncio
 import json
+import math
 import os
+import random
+import secrets
+import socket
 import time
+from collections import deque
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from typing import Dict, List, Tuple
+from fastapi.responses import JSONResponse, PlainTextResponse
+from typing import Dict, Iterable, List, Optional, Tuple
 import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+import message_codec
+from relay_metrics import LATENCY_BUCKETS_MS, SIZE_BUCKETS, MetricsRegistry, percentile
+from geo_partition import GeoPartitionIndex, VEHICLE_CELLS_KEY
+from spatial_grid import InMemoryGroupingBackend, compute_neighbours, haversine_m
+from traffic_capture import KIND_CLOSE, KIND_IN, KIND_OPEN, KIND_OUT, TrafficCapture, capture_path_for_worker
 
 # --- 설정 ---
 GROUPING_DISTANCE_M = 500
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
 
+# 히스테리시스: 진입 반경 안으로 들어와야 합류, 이탈 반경을 벗어나야 제거 (경계에서 그룹이 깜빡이는 것 방지)
+GROUP_ENTER_M = float(os.getenv("GROUP_ENTER_M", str(GROUPING_DISTANCE_M)))
+GROUP_LEAVE_M = max(GROUP_ENTER_M, float(os.getenv("GROUP_LEAVE_M", str(GROUPING_DISTANCE_M * 1.2))))
+# 예측 그룹핑: 최근 GPS 로 추정한 속도로 이 시간(초) 뒤 위치를 예측해 가까워지는 차량을 미리 합류 (0 이면 끔)
+GROUP_LOOKAHEAD_S = float(os.getenv("GROUP_LOOKAHEAD_S", "0"))
+MAX_PLAUSIBLE_SPEED_MPS = 70.0  # 이보다 빠른 속도는 GPS 튐으로 보고 무시
+MIN_LOOKAHEAD_SPEED_MPS = 1.0
+
+# 지역 분할 위치 인덱스: geohash 앞 N자리 셀마다 vehicles:{cell} 키로 나눔 (0 이면 단일 vehicles 키)
+# 4자리 셀 ≈ 20km x 30km, 5자리 ≈ 5km x 4km. 검색은 반경이 걸치는 셀 키만 확인
+GEO_PARTITION_PRECISION = int(os.getenv("GEO_PARTITION_PRECISION", "0"))
+# 셀 키를 여러 Redis 인스턴스에 나눌 때 (쉼표 구분). 비우면 REDIS_URL 하나에 모두 둠
+GEO_PARTITION_REDIS_URLS = [u for u in os.getenv("GEO_PARTITION_REDIS_URLS", "").split(",") if u]
+
+# 그룹핑 백엔드: redis(GEO 명령, 멀티 워커) | memory(인메모리 격자, 단일 프로세스 / Redis 불필요)
+GROUPING_BACKEND = os.getenv("GROUPING_BACKEND", "redis")
+USE_REDIS = GROUPING_BACKEND != "memory"
+
+# 멀티 워커 설정: 워커마다 고유 ID와 전용 Redis 채널을 가짐
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_CHANNEL_PREFIX = "worker:"
+NODE_WORKER_KEY = "node_workers"  # node_id -> worker_id 레지스트리 (Redis Hash)
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+
+# GPS 수신 경로: script(Lua 1회 왕복) | sequential(기존 4회 왕복) | compare(번갈아 실행하며 지연 비교)
+INGEST_MODE = os.getenv("INGEST_MODE", "script")
+INGEST_COMPARE_REPORT_EVERY = int(os.getenv("INGEST_COMPARE_REPORT_EVERY", "500"))
+
+# 그룹 멤버십은 join/leave 델타로만 알리고, 전체 좌표 스냅샷은 이 주기(초)로만 보냄
+GROUP_COORD_REFRESH_S = float(os.getenv("GROUP_COORD_REFRESH_S", "5"))
+
+# 그룹 재계산 스케줄러: per_fix(GPS 마다 계산) | tick(GPS 는 위치만 갱신, 고정 주기로 전체 그룹 일괄 계산)
+GROUP_SCHEDULER = os.getenv("GROUP_SCHEDULER", "per_fix")
+GROUP_TICK_HZ = float(os.getenv("GROUP_TICK_HZ", "3"))
+
+# 정지 차량 필터: 이 거리(m) 미만으로 움직였고 마지막 그룹 계산이 이 시간(초) 이내면 GEOSEARCH/publish 생략
+INGEST_MIN_MOVE_M = float(os.getenv("INGEST_MIN_MOVE_M", "5"))
+INGEST_MAX_SKIP_S = float(os.getenv("INGEST_MAX_SKIP_S", "10"))
+INGEST_STATS_FLUSH_S = float(os.getenv("INGEST_STATS_FLUSH_S", "30"))
+
+# 유령 차량 정리: last_seen 인덱스(Sorted Set) 기준으로 TTL 이 지난 노드를 일괄 삭제
+LAST_SEEN_KEY = "vehicles_last_seen"
+VEHICLE_TTL_S = float(os.getenv("VEHICLE_TTL_S", "60"))
+REAPER_INTERVAL_S = float(os.getenv("REAPER_INTERVAL_S", "10"))
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", "500"))
+REAPER_MAX_BATCHES = int(os.getenv("REAPER_MAX_BATCHES", "4"))  # 한 번의 sweep 당 최대 배치 수
+
+# 위치 기반 경고 방송: 경고 좌표 주변 반경(m) 안의 모든 접속 차량에게 전달
+GEO_ALERT_RADIUS_M = float(os.getenv("GEO_ALERT_RADIUS_M", "1000"))
+GEO_ALERT_MAX_RADIUS_M = float(os.getenv("GEO_ALERT_MAX_RADIUS_M", "5000"))
+GEO_ALERT_DEDUP_S = int(os.getenv("GEO_ALERT_DEDUP_S", "60"))  # 같은 alert_id 재방송 차단 시간
+
+# 세션 재개: 연결이 끊겨도 이 시간(초) 동안 그룹 상태를 유지하고 놓친 릴레이 메시지를 버퍼링
+SESSION_GRACE_S = float(os.getenv("SESSION_GRACE_S", "30"))
+SESSION_BUFFER_MAX = int(os.getenv("SESSION_BUFFER_MAX", "100"))
+BUFFERED_MESSAGE_TYPES = {"p2p_message"}
+INBOUND_MESSAGE_TYPES = {"gps", "p2p_relay", "group_relay", "geo_broadcast", "p2p_request", "p2p_response", "unknown"}
+
+# 웜 재시작: 종료 시 그룹/위치/세션 상태를 남기고, 재시작 후 재접속 차량에게 이전 그룹을 바로 돌려줌
+# 시작 직후 reaper 가 쉬는 시간. 0 이면 Redis 백엔드도 종료 시 웜 재시작 노드를 남기지 않음
+WARM_RESTART_GRACE_S = float(os.getenv("WARM_RESTART_GRACE_S", "60"))
+WARM_NODES_KEY = "warm_restart_nodes"  # 종료 직전 접속(또는 유예) 중이던 노드 (Redis Set)
+# memory 백엔드 스냅샷 파일 (예: warm_snapshot.json). 비어 있으면 저장/복원하지 않음
+WARM_SNAPSHOT_PATH = os.getenv("WARM_SNAPSHOT_PATH", "")
+WARM_SNAPSHOT_INTERVAL_S = float(os.getenv("WARM_SNAPSHOT_INTERVAL_S", "15"))
+WARM_SNAPSHOT_MAX_AGE_S = float(os.getenv("WARM_SNAPSHOT_MAX_AGE_S", "300"))  # 이보다 오래된 스냅샷은 무시
+
+# 접속 수락 속도 제한(워커당 토큰 버킷). 넘치면 지터를 섞은 retry_after_s 를 알려주고 1013 으로 닫음 (0 이면 끔)
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "200"))
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "400"))
+ADMISSION_MAX_RETRY_S = float(os.getenv("ADMISSION_MAX_RETRY_S", "30"))
+
+# 이벤트 루프 지연 측정 주기(초)
+LOOP_LAG_INTERVAL_S = float(os.getenv("LOOP_LAG_INTERVAL_S", "0.5"))
+
+# 트래픽 캡처: 경로를 주면 모든 웹소켓 프레임을 기록 (replay_capture.py 로 재생)
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")
+CAPTURE_FLUSH_S = float(os.getenv("CAPTURE_FLUSH_S", "1"))
+
+# 연결별 송신 큐 길이. 넘치면 가장 오래된 메시지를 버림 (group_update 는 최신 것 하나로 합침)
+OUTBOUND_QUEUE_MAX = int(os.getenv("OUTBOUND_QUEUE_MAX", "256"))
+
 # --- FastAPI 앱 및 Redis 클라이언트 설정 ---
 app = FastAPI()
 redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+memory_backend = None if USE_REDIS else InMemoryGroupingBackend(GROUP_LEAVE_M)
+
+# --- 메트릭 (/metrics: Prometheus 텍스트, /metrics.json: JSON) ---
+metrics = MetricsRegistry()
+messages_total = metrics.counter("relay_messages_total", "WebSocket messages by direction and type",
+                                 ["direction", "type"])
+bytes_total = metrics.counter("relay_bytes_total", "WebSocket payload bytes by direction and type",
+                              ["direction", "type"])
+redis_latency_ms = metrics.histogram("relay_redis_call_ms", "Redis call latency (ms)", LATENCY_BUCKETS_MS,
+                                     ["command"])
+fanout_size = metrics.histogram("relay_fanout_size", "Recipients per fan-out", SIZE_BUCKETS, ["kind"])
+delivery_failures = metrics.counter("relay_delivery_failures_total", "Messages that could not be delivered",
+                                    ["reason", "type"])
+# 스크랩 시점의 값이므로 누적 히스토그램이 아니라 게이지 (stat: max, p50, p99, sum)
+queue_depth = metrics.gauge("relay_send_queue_depth", "Per-connection send queue depth at scrape time", ["stat"])
+connections_gauge = metrics.gauge("relay_connections", "Connections held by this worker", ["state"])
+admission_rejected = metrics.counter("relay_admission_rejected_total", "Connections told to retry later")
+loop_lag_ms = metrics.histogram("relay_event_loop_lag_ms", "Event loop scheduling lag (ms)", LATENCY_BUCKETS_MS)
+loop_lag_last = metrics.gauge("relay_event_loop_lag_last_ms", "Most recent event loop lag sample (ms)")
+
+
+def frame_size(frame) -> int:
+    return len(frame) if isinstance(frame, (bytes, bytearray)) else len(frame.encode())
+
+
+# Redis 단일 명령은 execute_command 를, 파이프라인은 execute_pipeline 을 거치며 지연이 기록됨
+_redis_execute_command = redis_client.execute_command
+
+
+async def _timed_execute_command(*args, **options):
+    started = time.perf_counter()
+    try:
+        return await _redis_execute_command(*args, **options)
+    finally:
+        redis_latency_ms.observe((time.perf_counter() - started) * 1000, str(args[0]).upper())
+
+
+redis_client.execute_command = _timed_execute_command
+
+
+async def execute_pipeline(pipe):
+    started = time.perf_counter()
+    try:
+        return await pipe.execute()
+    finally:
+        redis_latency_ms.observe((time.perf_counter() - started) * 1000, "PIPELINE")
+
+
+geo_index = GeoPartitionIndex(
+    redis_client,
+    [aioredis.from_url(url, decode_responses=True) for url in GEO_PARTITION_REDIS_URLS],
+    GEO_PARTITION_PRECISION,
+    execute=execute_pipeline,
+)
+
+
+capture: Optional[TrafficCapture] = None
 
 active_connections: Dict[str, WebSocket] = {}
+outbound_counters = {"sent": 0, "dropped": 0, "coalesced": 0, "send_failed": 0}
+dropped_by_type: Dict[str, int] = {}
+
+
+class ConnectionWriter:
+    """연결별 bounded 송신 큐와 전용 writer 태스크.
+    느린 차량 하나가 다른 멤버로의 전달이나 송신자의 수신 루프를 막지 않도록 합니다."""
+
+    def __init__(self, node_id: str, websocket: WebSocket, encoding: str):
+        self.node_id = node_id
+        self.websocket = websocket
+        self.encoding = encoding
+        self.queue = deque()
+        self.pending_group_update = None  # 큐에 남아 있는 group_update 항목 (최신 것으로 덮어씀)
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def enqueue(self, msg_type: str, frame):
+        if msg_type == "group_update" and self.pending_group_update is not None:
+            self.pending_group_update[1] = frame
+            outbound_counters["coalesced"] += 1
+            return
+        if len(self.queue) >= OUTBOUND_QUEUE_MAX:
+            dropped = self.queue.popleft()
+            if dropped is self.pending_group_update:
+                self.pending_group_update = None
+            outbound_counters["dropped"] += 1
+            dropped_by_type[dropped[0]] = dropped_by_type.get(dropped[0], 0) + 1
+            delivery_failures.inc("queue_full", dropped[0])
+        entry = [msg_type, frame]
+        if msg_type == "group_update":
+            self.pending_group_update = entry
+        self.queue.append(entry)
+        self.wakeup.set()
+
+    async def _run(self):
+        while True:
+            while not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            entry = self.queue.popleft()
+            if entry is self.pending_group_update:
+                self.pending_group_update = None
+            try:
+                if isinstance(entry[1], bytes):
+                    await self.websocket.send_bytes(entry[1])
+                else:
+                    await self.websocket.send_text(entry[1])
+                outbound_counters["sent"] += 1
+                if capture is not None:
+                    capture.record(KIND_OUT, self.node_id, entry[1])
+                messages_total.inc("out", entry[0])
+                bytes_total.inc("out", entry[0], amount=frame_size(entry[1]))
+            except Exception:
+                outbound_counters["send_failed"] += 1
+                delivery_failures.inc("send_failed", entry[0])
+                return
+
+    def close(self):
+        self.task.cancel()
+
+
+connection_writers: Dict[str, ConnectionWriter] = {}
+
+
+def worker_channel(worker_id: str) -> str:
+    return f"{WORKER_CHANNEL_PREFIX}{worker_id}"
+
 
 # --- 핵심 로직: Redis의 위치기반 기능 활용 ---
 async def update_and_get_group(node_id: str, location: Tuple[float, float]) -> List[Dict]:
-    await redis_client.geoadd("vehicles", (location[1], location[0], node_id))
-    nearby_vehicles = await redis_client.geosearch(
-        "vehicles",
-        longitude=location[1],
-        latitude=location[0],
-        radius=GROUPING_DISTANCE_M,
-        unit="m",
-        withcoord=True,
-    )
+    """위치를 갱신하고 이탈 반경(GROUP_LEAVE_M) 안의 후보 차량을 반환합니다. 최종 멤버는 select_group_members 가 결정."""
+    if not USE_REDIS:
+        return memory_backend.update_and_get_group(node_id, location)
+    await geo_index.add(node_id, location[0], location[1])
+    nearby_vehicles = await geo_index.search(location[0], location[1], GROUP_LEAVE_M, withcoord=True)
     group_members = [{"node_id": name, "location": (lat, lon)} for name, (lon, lat) in nearby_vehicles]
     return group_members
 
 
+def select_group_members(node_id: str, location: Tuple[float, float], candidates: List[Dict],
+                         previous: Iterable[str], lookahead_ids: Iterable[str] = ()) -> List[Dict]:
+    """기존 멤버는 이탈 반경까지 유지하고, 새 멤버는 진입 반경 안이거나 예측 위치 근처일 때만 합류시킵니다."""
+    previous = set(previous)
+    lookahead_ids = set(lookahead_ids)
+    selected = []
+    for member in candidates:
+        other = member["node_id"]
+        if other == node_id or other in lookahead_ids:
+            selected.append(member)
+            continue
+        distance = haversine_m(location[0], location[1], member["location"][0], member["location"][1])
+        if distance <= (GROUP_LEAVE_M if other in previous else GROUP_ENTER_M):
+            selected.append(member)
+    return selected
+
+
+async def search_lookahead_ids(predicted: Optional[Tuple[float, float]]) -> List[str]:
+    """예측 위치 주변(진입 반경)의 차량 ID. 이탈 반경 후보 안에 있는 차량만 실제로 합류에 쓰입니다."""
+    if predicted is None:
+        return []
+    if not USE_REDIS:
+        return [name for name, _ in memory_backend.grid.search(predicted[0], predicted[1], GROUP_ENTER_M)]
+    return await geo_index.search(predicted[0], predicted[1], GROUP_ENTER_M)
+
+
+# --- GPS 수신(ingest) 경로 ---
+# peer 해시 갱신 + GEOADD + GEOSEARCH + 멤버십 델타 계산을 Redis 안에서 한 번에 처리 (Redis 6.2+)
+# 보낼 메시지는 JSON 으로 돌려받아 소유 워커별로 라우팅 (없으면 빈 문자열)
+# group:{id} 는 대칭 인접 집합 (A 그룹에 B가 있으면 B 그룹에도 A가 있음)
+INGEST_LUA = """
+local id = ARGV[1]
+local now = tonumber(ARGV[4])
+redis.call('HSET', KEYS[1], 'node_id', id, 'location', ARGV[2] .. ',' .. ARGV[3], 'last_seen', ARGV[4])
+redis.call('GEOADD', KEYS[2], ARGV[3], ARGV[2], id)
+redis.call('ZADD', KEYS[3], ARGV[4], id)
+-- 지역 분할 인덱스: KEYS[4] 는 node_id -> 셀 키 레지스트리, KEYS[5..] 는 검색 원이 걸치는 셀 키들
+local search_keys = {KEYS[2]}
+if KEYS[4] then
+    local old_key = redis.call('HGET', KEYS[4], id)
+    if old_key ~= KEYS[2] then
+        if old_key then redis.call('ZREM', old_key, id) end
+        redis.call('HSET', KEYS[4], id, KEYS[2])
+    end
+    search_keys = {unpack(KEYS, 5)}
+end
+local group_key = 'group:' .. id
+local enter, leave = tonumber(ARGV[5]), tonumber(ARGV[7])
+local previous = {}
+for _, other in ipairs(redis.call('SMEMBERS', group_key)) do previous[other] = true end
+-- 예측 위치(ARGV[8], ARGV[9]) 주변 차량은 진입 반경 밖이어도 합류 후보
+local ahead = {}
+if ARGV[8] ~= '' then
+    for _, key in ipairs(search_keys) do
+        for _, other in ipairs(redis.call('GEOSEARCH', key, 'FROMLONLAT', ARGV[9], ARGV[8], 'BYRADIUS', enter, 'm')) do
+            ahead[other] = true
+        end
+    end
+end
+-- 이탈 반경으로 검색한 뒤 기존 멤버는 leave, 새 멤버는 enter(또는 예측) 기준으로 선별 (히스테리시스)
+local found = {}
+for _, key in ipairs(search_keys) do
+    for _, item in ipairs(redis.call('GEOSEARCH', key, 'FROMLONLAT', ARGV[3], ARGV[2], 'BYRADIUS', leave, 'm',
+                                     'WITHDIST', 'WITHCOORD')) do
+        found[#found + 1] = item
+    end
+end
+local members = {}
+local current = {}
+for _, item in ipairs(found) do
+    local name, dist = item[1], tonumber(item[2])
+    local loc = {tonumber(item[3][2]), tonumber(item[3][1])}
+    local limit = previous[name] and leave or enter
+    if name == id or dist <= limit or ahead[name] then
+        members[#members + 1] = {node_id = name, location = loc}
+        if name ~= id then current[name] = loc end
+    end
+end
+
+local joined, joined_ids, left = {}, {}, {}
+for other, _ in pairs(previous) do
+    if current[other] == nil then
+        left[#left + 1] = other
+        redis.call('SREM', group_key, other)
+        redis.call('SREM', 'group:' .. other, id)
+    end
+end
+for other, loc in pairs(current) do
+    if redis.call('SADD', group_key, other) == 1 then
+        redis.call('SADD', 'group:' .. other, id)
+        joined[#joined + 1] = {node_id = other, location = loc}
+        joined_ids[#joined_ids + 1] = other
+    end
+end
+
+local messages = {}
+if #joined > 0 or #left > 0 then
+    local own = {type = 'group_delta'}
+    if #joined > 0 then own.joined = joined end
+    if #left > 0 then own.left = left end
+    messages[#messages + 1] = {targets = {id}, payload = own}
+end
+if #joined_ids > 0 then
+    local me = {{node_id = id, location = {tonumber(ARGV[2]), tonumber(ARGV[3])}}}
+    messages[#messages + 1] = {targets = joined_ids, payload = {type = 'group_delta', joined = me}}
+end
+if #left > 0 then
+    messages[#messages + 1] = {targets = left, payload = {type = 'group_delta', left = {id}}}
+end
+local coords_at = tonumber(redis.call('HGET', KEYS[1], 'coords_at') or '0')
+if now - coords_at >= tonumber(ARGV[6]) then
+    redis.call('HSET', KEYS[1], 'coords_at', ARGV[4])
+    messages[#messages + 1] = {targets = {id}, payload = {type = 'group_update', data = members}}
+end
+if #messages == 0 then
+    return ''
+end
+return cjson.encode(messages)
+"""
+ingest_script = redis_client.register_script(INGEST_LUA)
+# 셀 키가 여러 Redis 에 나뉘어 있으면 한 스크립트로 처리할 수 없으므로 순차 경로 사용
+ingest_script_available = not geo_index.sharded
+
+
+class LatencyStats:
+    """최근 샘플(ms)로 p50/p99 를 계산하는 간단한 통계."""
+
+    def __init__(self, maxlen: int = 2000):
+        self.samples = deque(maxlen=maxlen)
+        self.count = 0
+
+    def add(self, ms: float):
+        self.samples.append(ms)
+        self.count += 1
+
+    def percentile(self, p: float) -> float:
+        return percentile(sorted(self.samples), p)
+
+    def summary(self) -> str:
+        return f"n={self.count} p50={self.percentile(0.5):.2f}ms p99={self.percentile(0.99):.2f}ms"
+
+
+ingest_latency = {"script": LatencyStats(), "sequential": LatencyStats()}
+ingest_fix_count = 0
+
+# 노드별 마지막 그룹 계산 위치/시각: node_id -> (lat, lon, evaluated_at)
+last_evaluated: Dict[str, Tuple[float, float, float]] = {}
+ingest_counters = {"fixes": 0, "evaluated": 0, "suppressed": 0, "invalid": 0}
+GEO_MAX_LAT = 85.05112878  # Redis GEOADD 가 받는 위도 범위
+
+# 노드별 최근 위치와 추정 속도: node_id -> (lat, lon, t, vlat, vlon)  (속도 단위: 도/초)
+motion_state: Dict[str, Tuple[float, float, float, float, float]] = {}
+
+
+def update_motion(node_id: str, loc_tuple: Tuple[float, float], now: float):
+    previous = motion_state.get(node_id)
+    vlat = vlon = 0.0
+    if previous is not None and now > previous[2]:
+        dt = now - previous[2]
+        speed = haversine_m(previous[0], previous[1], loc_tuple[0], loc_tuple[1]) / dt
+        if speed <= MAX_PLAUSIBLE_SPEED_MPS:
+            # 지수 평활로 GPS 잡음을 줄임
+            vlat = 0.5 * previous[3] + 0.5 * (loc_tuple[0] - previous[0]) / dt
+            vlon = 0.5 * previous[4] + 0.5 * (loc_tuple[1] - previous[1]) / dt
+        else:
+            vlat, vlon = previous[3], previous[4]
+    motion_state[node_id] = (loc_tuple[0], loc_tuple[1], now, vlat, vlon)
+
+
+def predict_position(node_id: str) -> Optional[Tuple[float, float]]:
+    """GROUP_LOOKAHEAD_S 뒤의 예측 위치. 예측이 꺼져 있거나 거의 정지한 차량이면 None."""
+    state = motion_state.get(node_id)
+    if GROUP_LOOKAHEAD_S <= 0 or state is None:
+        return None
+    lat, lon, _, vlat, vlon = state
+    predicted = (lat + vlat * GROUP_LOOKAHEAD_S, lon + vlon * GROUP_LOOKAHEAD_S)
+    if haversine_m(lat, lon, predicted[0], predicted[1]) < MIN_LOOKAHEAD_SPEED_MPS * GROUP_LOOKAHEAD_S:
+        return None
+    return predicted
+
+
+def should_evaluate(node_id: str, loc_tuple: Tuple[float, float], now: float) -> bool:
+    """충분히 움직였거나 마지막 그룹 계산이 오래된 경우에만 True."""
+    previous = last_evaluated.get(node_id)
+    if previous is None or now - previous[2] >= INGEST_MAX_SKIP_S:
+        return True
+    return haversine_m(previous[0], previous[1], loc_tuple[0], loc_tuple[1]) >= INGEST_MIN_MOVE_M
+
+
+async def touch_last_seen(node_id: str, now: float):
+    if not USE_REDIS:
+        memory_backend.touch(node_id, now)
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(f"peer:{node_id}", "last_seen", now)
+    pipe.zadd(LAST_SEEN_KEY, {node_id: now})
+    await execute_pipeline(pipe)
+
+
+def parse_gps_fix(message: Dict) -> Optional[Tuple[float, float]]:
+    """유한한 숫자이고 Redis GEO 범위 안의 좌표만 받습니다. 아니면 None."""
+    try:
+        lat, lon = float(message["latitude"]), float(message["longitude"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lon) and abs(lat) <= GEO_MAX_LAT and abs(lon) <= 180):
+        return None
+    return lat, lon
+
+
+def script_unsupported(error: ResponseError) -> bool:
+    """이 Redis 가 ingest 스크립트 자체를 실행할 수 없는 오류인지 (명령 미지원, 컴파일 실패)."""
+    text = str(error).lower()
+    return "unknown command" in text or "error compiling script" in text or "unknown redis command" in text
+
+
+async def handle_gps_fix(node_id: str, loc_tuple: Tuple[float, float]):
+    """정지 차량 필터를 거친 뒤 그룹 계산(ingest) 또는 last_seen 갱신만 수행합니다."""
+    now = time.time()
+    ingest_counters["fixes"] += 1
+    update_motion(node_id, loc_tuple, now)
+    if not should_evaluate(node_id, loc_tuple, now):
+        ingest_counters["suppressed"] += 1
+        await touch_last_seen(node_id, now)
+        return
+    ingest_counters["evaluated"] += 1
+    last_evaluated[node_id] = (loc_tuple[0], loc_tuple[1], now)
+    if GROUP_SCHEDULER == "tick":
+        await update_position(node_id, loc_tuple, now)
+    else:
+        await ingest_gps(node_id, loc_tuple, predict_position(node_id))
+
+
+async def ingest_stats_reporter():
+    """필터 카운터를 stats:ingest:{WORKER_ID} 해시로 주기적으로 게시합니다."""
+    while True:
+        await asyncio.sleep(INGEST_STATS_FLUSH_S)
+        try:
+            if USE_REDIS:
+                await redis_client.hset(f"stats:ingest:{WORKER_ID}",
+                                        mapping={**ingest_counters, "updated_at": time.time()})
+                await redis_client.hset(f"stats:outbound:{WORKER_ID}",
+                                        mapping={**outbound_counters, "updated_at": time.time()})
+            print(f"📊 ingest 통계: 수신 {ingest_counters['fixes']} / 그룹 계산 {ingest_counters['evaluated']}"
+                  f" / 생략 {ingest_counters['suppressed']}")
+            if GROUP_SCHEDULER == "tick":
+                print(f"📊 그룹 틱: {tick_counters}")
+            if outbound_counters["dropped"] or outbound_counters["coalesced"]:
+                print(f"📊 송신 큐: 버림 {outbound_counters['dropped']} {dropped_by_type}"
+                      f" / 합침 {outbound_counters['coalesced']}")
+        except Exception as e:
+            print(f"⚠️ ingest 통계 게시 실패: {e}")
+
+
+def build_group_messages(node_id: str, location: Tuple[float, float], group_members: List[Dict],
+                         joined: List[Dict], left: List[str], send_coords: bool) -> List[Dict]:
+    """멤버십 변화(join/leave)는 관련 차량에게만, 좌표 스냅샷은 본인에게만 보내는 메시지 목록을 만듭니다."""
+    messages = []
+    if joined or left:
+        own = {"type": "group_delta"}
+        if joined:
+            own["joined"] = joined
+        if left:
+            own["left"] = left
+        messages.append({"targets": [node_id], "payload": own})
+    if joined:
+        me = [{"node_id": node_id, "location": location}]
+        messages.append({"targets": [m["node_id"] for m in joined],
+                         "payload": {"type": "group_delta", "joined": me}})
+    if left:
+        messages.append({"targets": left, "payload": {"type": "group_delta", "left": [node_id]}})
+    if send_coords:
+        messages.append({"targets": [node_id], "payload": {"type": "group_update", "data": group_members}})
+    return messages
+
+
+async def diff_group_membership(node_id: str, location: Tuple[float, float], candidates: List[Dict],
+                                lookahead_ids: Iterable[str] = ()) -> Tuple[List[Dict], List[Dict], List[str]]:
+    """group:{node_id} 에 저장된 이전 멤버십 기준으로 히스테리시스를 적용해 그룹을 정하고,
+    대칭 인접 집합을 갱신한 뒤 (group_members, joined, left)를 반환합니다."""
+    if not USE_REDIS:
+        previous = memory_backend.groups.get(node_id, set())
+        group_members = select_group_members(node_id, location, candidates, previous, lookahead_ids)
+        return (group_members, *memory_backend.diff_group_membership(node_id, group_members))
+    group_key = f"group:{node_id}"
+    previous = await redis_client.smembers(group_key)
+    group_members = select_group_members(node_id, location, candidates, previous, lookahead_ids)
+    current = {m["node_id"]: m["location"] for m in group_members if m["node_id"] != node_id}
+    joined = [{"node_id": other, "location": loc} for other, loc in current.items() if other not in previous]
+    left = [other for other in previous if other not in current]
+    if joined or left:
+        pipe = redis_client.pipeline(transaction=False)
+        for other in left:
+            pipe.srem(group_key, other)
+            pipe.srem(f"group:{other}", node_id)
+        for member in joined:
+            pipe.sadd(group_key, member["node_id"])
+            pipe.sadd(f"group:{member['node_id']}", node_id)
+        await execute_pipeline(pipe)
+    return group_members, joined, left
+
+
+async def get_group_ids(node_id: str) -> List[str]:
+    """서버가 알고 있는 node_id 의 현재 그룹 멤버(본인 제외)."""
+    if not USE_REDIS:
+        return list(memory_backend.groups.get(node_id, ()))
+    return list(await redis_client.smembers(f"group:{node_id}"))
+
+
+# --- 위치 기반 경고 방송 ---
+recent_geo_alerts: Dict[str, float] = {}  # memory 백엔드용 alert_id -> 만료 시각
+
+
+async def claim_geo_alert(alert_id: Optional[str]) -> bool:
+    """같은 alert_id 가 이미 방송됐으면 False (재전송/중복 신고 차단)."""
+    if not alert_id:
+        return True
+    if USE_REDIS:
+        return bool(await redis_client.set(f"geo_alert:{alert_id}", WORKER_ID, nx=True, ex=GEO_ALERT_DEDUP_S))
+    now = time.time()
+    for expired_id in [a for a, until in recent_geo_alerts.items() if until < now]:
+        del recent_geo_alerts[expired_id]
+    if alert_id in recent_geo_alerts:
+        return False
+    recent_geo_alerts[alert_id] = now + GEO_ALERT_DEDUP_S
+    return True
+
+
+async def search_vehicles_near(lat: float, lon: float, radius_m: float) -> List[str]:
+    if not USE_REDIS:
+        return [name for name, _ in memory_backend.grid.search(lat, lon, radius_m)]
+    return await geo_index.search(lat, lon, radius_m)
+
+
+async def handle_geo_broadcast(node_id: str, message: Dict):
+    """경고 좌표에서 한 번의 공간 검색으로 대상 차량을 찾고, P2P 로 이미 받은 차량(exclude)은 제외하고 전달합니다."""
+    try:
+        lat, lon = float(message["latitude"]), float(message["longitude"])
+        radius_m = min(float(message.get("radius_m") or GEO_ALERT_RADIUS_M), GEO_ALERT_MAX_RADIUS_M)
+        exclude = set(message.get("exclude") or [])
+    except (KeyError, TypeError, ValueError):
+        return
+    if not radius_m > 0:  # 음수 / NaN
+        return
+    if not await claim_geo_alert(message.get("alert_id")):
+        return
+    exclude.add(node_id)
+    targets = [t for t in await search_vehicles_near(lat, lon, radius_m) if t not in exclude]
+    if targets:
+        await route_to_nodes(targets, {
+            "type": "p2p_message",
+            "from_id": node_id,
+            "content": message.get("content"),
+            "alert_id": message.get("alert_id"),
+        })
+
+
+async def remove_node_from_groups(node_id: str):
+    """차량이 빠질 때 이웃들의 인접 집합에서 제거하고 leave 델타를 보냅니다."""
+    if not USE_REDIS:
+        neighbours = memory_backend.remove(node_id)
+        if neighbours:
+            await route_to_nodes(neighbours, {"type": "group_delta", "left": [node_id]})
+        return
+    group_key = f"group:{node_id}"
+    neighbours = list(await redis_client.smembers(group_key))
+    pipe = redis_client.pipeline(transaction=False)
+    for other in neighbours:
+        pipe.srem(f"group:{other}", node_id)
+    pipe.delete(group_key)
+    await execute_pipeline(pipe)
+    if neighbours:
+        await route_to_nodes(neighbours, {"type": "group_delta", "left": [node_id]})
+
+
+async def ingest_sequential(node_id: str, loc_tuple: Tuple[float, float],
+                            predicted: Optional[Tuple[float, float]] = None):
+    now = time.time()
+    await redis_client.hset(f"peer:{node_id}", mapping={
+        "node_id": node_id, "location": f"{loc_tuple[0]},{loc_tuple[1]}",
+        "last_seen": now
+    })
+    await redis_client.zadd(LAST_SEEN_KEY, {node_id: now})
+    candidates = await update_and_get_group(node_id, loc_tuple)
+    lookahead_ids = await search_lookahead_ids(predicted)
+    group_members, joined, left = await diff_group_membership(node_id, loc_tuple, candidates, lookahead_ids)
+    coords_at = float(await redis_client.hget(f"peer:{node_id}", "coords_at") or 0)
+    send_coords = now - coords_at >= GROUP_COORD_REFRESH_S
+    if send_coords:
+        await redis_client.hset(f"peer:{node_id}", "coords_at", now)
+    messages = build_group_messages(node_id, loc_tuple, group_members, joined, left, send_coords)
+    if messages:
+        await deliver_group_messages(messages)
+
+
+async def ingest_lua(node_id: str, loc_tuple: Tuple[float, float], predicted: Optional[Tuple[float, float]] = None):
+    own_key = geo_index.key_for(loc_tuple[0], loc_tuple[1])
+    keys = [f"peer:{node_id}", own_key, LAST_SEEN_KEY]
+    if geo_index.partitioned:
+        search_keys = geo_index.keys_near(loc_tuple[0], loc_tuple[1], GROUP_LEAVE_M)
+        if predicted is not None:
+            search_keys += [k for k in geo_index.keys_near(predicted[0], predicted[1], GROUP_ENTER_M)
+                            if k not in search_keys]
+        keys += [VEHICLE_CELLS_KEY, *search_keys]
+    encoded = await ingest_script(
+        keys=keys,
+        args=[node_id, loc_tuple[0], loc_tuple[1], time.time(), GROUP_ENTER_M,
+              GROUP_COORD_REFRESH_S, GROUP_LEAVE_M,
+              predicted[0] if predicted else "", predicted[1] if predicted else ""],
+    )
+    if encoded:
+        await deliver_group_messages(json.loads(encoded))
+
+
+async def ingest_memory(node_id: str, loc_tuple: Tuple[float, float],
+                        predicted: Optional[Tuple[float, float]] = None):
+    now = time.time()
+    memory_backend.touch(node_id, now)
+    candidates = memory_backend.update_and_get_group(node_id, loc_tuple)
+    lookahead_ids = await search_lookahead_ids(predicted)
+    group_members, joined, left = await diff_group_membership(node_id, loc_tuple, candidates, lookahead_ids)
+    send_coords = memory_backend.take_coords_slot(node_id, now, GROUP_COORD_REFRESH_S)
+    await deliver_group_messages(build_group_messages(node_id, loc_tuple, group_members, joined, left, send_coords))
+
+
+async def ingest_gps(node_id: str, loc_tuple: Tuple[float, float], predicted: Optional[Tuple[float, float]] = None):
+    """INGEST_MODE 에 따라 GPS 한 건을 처리합니다. 스크립트 실패 시 기존 순차 경로로 전환."""
+    global ingest_script_available, ingest_fix_count
+    if not USE_REDIS:
+        await ingest_memory(node_id, loc_tuple, predicted)
+        return
+    ingest_fix_count += 1
+    if INGEST_MODE == "compare" and ingest_script_available:
+        path = "script" if ingest_fix_count % 2 else "sequential"
+    elif INGEST_MODE == "script" and ingest_script_available:
+        path = "script"
+    else:
+        path = "sequential"
+
+    started = time.perf_counter()
+    if path == "script":
+        try:
+            await ingest_lua(node_id, loc_tuple, predicted)
+        except ResponseError as e:
+            if script_unsupported(e):
+                print(f"⚠️ 이 Redis 에서 Lua ingest 스크립트를 쓸 수 없어 순차 경로로 전환합니다: {e}")
+                ingest_script_available = False
+            else:
+                # 이 GPS 한 건만의 오류일 수 있으므로 이번 건만 순차 경로로 처리
+                print(f"⚠️ Lua ingest 스크립트 실패, 이번 GPS 만 순차 경로로 처리합니다: {e}")
+            path = "sequential"
+            started = time.perf_counter()
+            await ingest_sequential(node_id, loc_tuple, predicted)
+    else:
+        await ingest_sequential(node_id, loc_tuple, predicted)
+    ingest_latency[path].add((time.perf_counter() - started) * 1000)
+
+    if INGEST_MODE == "compare" and ingest_fix_count % INGEST_COMPARE_REPORT_EVERY == 0:
+        print(f"⏱️ ingest 비교 | script {ingest_latency['script'].summary()}"
+              f" | sequential {ingest_latency['sequential'].summary()}")
+
+
+# --- 틱 기반 그룹 재계산 ---
+tick_adjacency: Dict[str, set] = {}  # 마지막 틱에서 계산한 이웃 집합 (틱 리더 워커만 유지)
+tick_coords_at: Dict[str, float] = {}
+tick_previous_positions: Tuple[float, Dict[str, Tuple[float, float]]] = (0.0, {})  # 예측용 직전 틱 위치
+tick_counters = {"ticks": 0, "last_vehicles": 0, "last_messages": 0, "last_tick_ms": 0.0}
+
+
+async def update_position(node_id: str, loc_tuple: Tuple[float, float], now: float):
+    """tick 모드: 위치와 last_seen 만 갱신하고 그룹 계산은 틱에 맡깁니다."""
+    if not USE_REDIS:
+        memory_backend.grid.update(node_id, loc_tuple[0], loc_tuple[1])
+        memory_backend.touch(node_id, now)
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(f"peer:{node_id}", mapping={
+        "node_id": node_id, "location": f"{loc_tuple[0]},{loc_tuple[1]}", "last_seen": now
+    })
+    pipe.zadd(LAST_SEEN_KEY, {node_id: now})
+    await execute_pipeline(pipe)
+    await geo_index.add(node_id, loc_tuple[0], loc_tuple[1])
+
+
+async def load_all_positions() -> Dict[str, Tuple[float, float]]:
+    if not USE_REDIS:
+        return dict(memory_backend.grid.positions)
+    return await geo_index.all_positions()
+
+
+def predict_tick_positions(positions: Dict[str, Tuple[float, float]], now: float) -> Dict[str, Tuple[float, float]]:
+    """직전 틱 위치와의 차이로 속도를 추정해 GROUP_LOOKAHEAD_S 뒤 위치를 예측합니다."""
+    global tick_previous_positions
+    previous_at, previous = tick_previous_positions
+    tick_previous_positions = (now, positions)
+    dt = now - previous_at
+    if GROUP_LOOKAHEAD_S <= 0 or not previous or dt <= 0:
+        return {}
+    predicted = {}
+    for node_id, (lat, lon) in positions.items():
+        before = previous.get(node_id)
+        if before is None:
+            continue
+        moved = haversine_m(before[0], before[1], lat, lon)
+        if moved / dt < MIN_LOOKAHEAD_SPEED_MPS or moved / dt > MAX_PLAUSIBLE_SPEED_MPS:
+            continue
+        scale = GROUP_LOOKAHEAD_S / dt
+        predicted[node_id] = (lat + (lat - before[0]) * scale, lon + (lon - before[1]) * scale)
+    return predicted
+
+
+def build_tick_messages(positions: Dict[str, Tuple[float, float]], neighbours: Dict[str, set],
+                        now: float) -> List[Dict]:
+    """차량당 최대 1개: 좌표 갱신 차례면 전체 스냅샷, 아니면 멤버십이 바뀐 경우에만 델타."""
+    messages = []
+    for node_id, current in neighbours.items():
+        previous = tick_adjacency.get(node_id, set())
+        if now - tick_coords_at.get(node_id, 0.0) >= GROUP_COORD_REFRESH_S:
+            tick_coords_at[node_id] = now
+            members = [{"node_id": m, "location": positions[m]} for m in current | {node_id}]
+            messages.append({"targets": [node_id], "payload": {"type": "group_update", "data": members}})
+        elif current != previous:
+            delta = {"type": "group_delta"}
+            joined = current - previous
+            left = previous - current
+            if joined:
+                delta["joined"] = [{"node_id": m, "location": positions[m]} for m in joined]
+            if left:
+                delta["left"] = list(left)
+            messages.append({"targets": [node_id], "payload": delta})
+    for gone in set(tick_coords_at) - set(neighbours):
+        del tick_coords_at[gone]
+    return messages
+
+
+async def store_tick_adjacency(neighbours: Dict[str, set]):
+    """바뀐 이웃 집합만 group:{id} 에 반영해 group_relay 와 연결 종료 처리가 다른 워커에서도 멤버십을 보게 합니다."""
+    if not USE_REDIS:
+        memory_backend.groups = {node_id: set(current) for node_id, current in neighbours.items()}
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    changed = False
+    for node_id in set(neighbours) | set(tick_adjacency):
+        current = neighbours.get(node_id, set())
+        previous = tick_adjacency.get(node_id, set())
+        if current == previous:
+            continue
+        changed = True
+        if not current:
+            pipe.delete(f"group:{node_id}")
+            continue
+        if previous - current:
+            pipe.srem(f"group:{node_id}", *(previous - current))
+        if current - previous:
+            pipe.sadd(f"group:{node_id}", *(current - previous))
+    if changed:
+        await execute_pipeline(pipe)
+
+
+async def load_stored_adjacency(node_ids: Iterable[str]) -> Dict[str, set]:
+    """새 틱 리더(재시작, 리더 교체)는 저장된 그룹을 이어받아 전원에게 join 델타가 쏟아지지 않게 합니다."""
+    if not USE_REDIS:
+        return {node_id: set(current) for node_id, current in memory_backend.groups.items()}
+    node_ids = list(node_ids)
+    if not node_ids:
+        return {}
+    pipe = redis_client.pipeline(transaction=False)
+    for node_id in node_ids:
+        pipe.smembers(f"group:{node_id}")
+    return {n: set(members) for n, members in zip(node_ids, await execute_pipeline(pipe)) if members}
+
+
+async def acquire_tick_leadership(ttl_ms: int) -> bool:
+    """틱 리더는 한 워커에 고정되어야 이전 이웃 집합(tick_adjacency)이 이어짐. 소유 중이면 연장."""
+    if not USE_REDIS:
+        return True
+    if await redis_client.set("group_tick_lock", WORKER_ID, nx=True, px=ttl_ms):
+        return True
+    if await redis_client.get("group_tick_lock") == WORKER_ID:
+        await redis_client.pexpire("group_tick_lock", ttl_ms)
+        return True
+    return False
+
+
+async def group_tick_loop():
+    global tick_adjacency
+    interval = 1.0 / GROUP_TICK_HZ
+    next_tick = time.perf_counter()
+    print(f"⏲️ 틱 기반 그룹 재계산 시작 ({GROUP_TICK_HZ}Hz)")
+    while True:
+        next_tick += interval
+        await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+        try:
+            if not await acquire_tick_leadership(int(interval * 3000)):
+                tick_adjacency = {}
+                predict_tick_positions({}, 0.0)
+                continue
+            started = time.perf_counter()
+            positions = await load_all_positions()
+            if not tick_adjacency:
+                tick_adjacency = await load_stored_adjacency(positions)
+            predicted = predict_tick_positions(positions, time.time())
+            neighbours = compute_neighbours(positions, GROUP_ENTER_M, GROUP_LEAVE_M, tick_adjacency, predicted)
+            messages = build_tick_messages(positions, neighbours, time.time())
+            await store_tick_adjacency(neighbours)
+            tick_adjacency = neighbours
+            if messages:
+                await deliver_group_messages(messages)
+            tick_counters["ticks"] += 1
+            tick_counters["last_vehicles"] = len(positions)
+            tick_counters["last_messages"] = len(messages)
+            tick_counters["last_tick_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        except Exception as e:
+            print(f"⚠️ 그룹 틱 처리 실패: {e}")
+        if time.perf_counter() > next_tick + interval:
+            next_tick = time.perf_counter()  # 처리 시간이 주기를 넘으면 밀린 틱은 건너뜀
+
+
+# --- 워커 간 메시지 라우팅 ---
+async def send_local(node_id: str, payload: Dict, frame_cache: Optional[Dict] = None) -> bool:
+    """이 워커에 붙어 있는 연결의 송신 큐에 넣습니다. 연결이 없으면 False.
+    frame_cache 를 넘기면 같은 payload 를 인코딩별로 한 번만 직렬화합니다."""
+    writer = connection_writers.get(node_id)
+    if writer is None:
+        if node_id in suspended_sessions and payload.get("type") in BUFFERED_MESSAGE_TYPES:
+            await buffer_session_message(node_id, payload)
+            return True
+        delivery_failures.inc("not_connected", payload.get("type", ""))
+        return False
+    if frame_cache is not None and writer.encoding in frame_cache:
+        frame = frame_cache[writer.encoding]
+    else:
+        frame = message_codec.encode(payload, writer.encoding)
+        if frame_cache is not None:
+            frame_cache[writer.encoding] = frame
+    writer.enqueue(payload.get("type", ""), frame)
+    return True
+
+
+async def deliver_local_group_messages(messages: List[Dict]):
+    """[{"targets": [...], "payload": {...}}] 형식의 메시지 중 이 워커에 연결된 대상에게만 전달합니다."""
+    for group_message in messages:
+        frame_cache = {}
+        for target_id in group_message["targets"]:
+            if target_id in active_connections:
+                await send_local(target_id, group_message["payload"], frame_cache)
+
+
+async def deliver_group_messages(messages: List[Dict]):
+    """그룹 메시지를 로컬 연결에는 바로 보내고, 나머지 대상은 레지스트리로 소유 워커를 찾아
+    워커마다 한 번만 publish 합니다 (모든 워커가 전체 메시지를 받아 걸러내지 않도록)."""
+    remote_ids = set()
+    for group_message in messages:
+        fanout_size.observe(len(group_message["targets"]), "group_update")
+        frame_cache = {}
+        for target_id in group_message["targets"]:
+            if target_id in active_connections:
+                await send_local(target_id, group_message["payload"], frame_cache)
+            elif USE_REDIS and target_id not in suspended_sessions:
+                remote_ids.add(target_id)
+    if not remote_ids:
+        return
+
+    remote_ids = list(remote_ids)
+    owners = dict(zip(remote_ids, await redis_client.hmget(NODE_WORKER_KEY, remote_ids)))
+    by_worker: Dict[str, List[Dict]] = {}
+    for group_message in messages:
+        targets_by_owner: Dict[str, List[str]] = {}
+        for target_id in group_message["targets"]:
+            owner = owners.get(target_id)
+            if owner and owner != WORKER_ID:
+                targets_by_owner.setdefault(owner, []).append(target_id)
+        for owner, targets in targets_by_owner.items():
+            by_worker.setdefault(owner, []).append({"targets": targets, "payload": group_message["payload"]})
+    for owner, worker_messages in by_worker.items():
+        receivers = await redis_client.publish(worker_channel(owner), json.dumps({"messages": worker_messages}))
+        if not receivers:
+            # 그룹 상태는 다음 갱신에서 다시 보내지므로 버퍼링하지 않고 집계만 함
+            for group_message in worker_messages:
+                delivery_failures.inc("no_subscriber", group_message["payload"].get("type", ""),
+                                      amount=len(group_message["targets"]))
+
+
+async def route_to_nodes(node_ids: Iterable[str], payload: Dict):
+    """로컬 연결은 바로 보내고, 나머지는 레지스트리를 조회해 소유 워커의 채널로 한 번씩 publish 합니다."""
+    node_ids = list(node_ids)
+    fanout_size.observe(len(node_ids), payload.get("type", ""))
+    remote_ids = []
+    frame_cache = {}
+    for target_id in node_ids:
+        if target_id in active_connections or target_id in suspended_sessions:
+            await send_local(target_id, payload, frame_cache)
+        else:
+            remote_ids.append(target_id)
+    if not remote_ids or not USE_REDIS:
+        return
+
+    owners = await redis_client.hmget(NODE_WORKER_KEY, remote_ids)
+    by_worker: Dict[str, List[str]] = {}
+    for target_id, owner in zip(remote_ids, owners):
+        if owner and owner != WORKER_ID:
+            by_worker.setdefault(owner, []).append(target_id)
+        elif owner == WORKER_ID:
+            # 레지스트리상 이 워커 소유인데 연결도 유예 상태도 아님 (정리 중이거나 레지스트리가 늦게 지워짐)
+            delivery_failures.inc("not_connected", payload.get("type", ""))
+        else:
+            delivery_failures.inc("no_route", payload.get("type", ""))
+    for owner, targets in by_worker.items():
+        await publish_to_worker(owner, targets, payload)
+
+
+async def publish_to_worker(owner: str, targets: List[str], payload: Dict):
+    """소유 워커 채널로 publish. 듣는 워커가 없으면(재시작으로 WORKER_ID 가 바뀐 경우 등)
+    릴레이 메시지는 세션 버퍼에 넣어 재접속 시 재전송되게 하고 실패로 집계합니다."""
+    receivers = await redis_client.publish(worker_channel(owner), json.dumps({"targets": targets, "payload": payload}))
+    if receivers:
+        return
+    msg_type = payload.get("type", "")
+    delivery_failures.inc("no_subscriber", msg_type, amount=len(targets))
+    if msg_type in BUFFERED_MESSAGE_TYPES:
+        for target_id in targets:
+            await buffer_session_message(target_id, payload)
+
+
+async def register_node(node_id: str):
+    if not USE_REDIS:
+        return
+    await redis_client.hset(NODE_WORKER_KEY, node_id, WORKER_ID)
+
+
+async def unregister_node(node_id: str):
+    if not USE_REDIS:
+        return
+    # 다른 워커로 재접속한 경우 그 워커의 등록을 지우지 않도록 소유자를 확인
+    if await redis_client.hget(NODE_WORKER_KEY, node_id) == WORKER_ID:
+        await redis_client.hdel(NODE_WORKER_KEY, node_id)
+
+
+# --- 세션 재개(resume) ---
+# 이 워커에서 끊긴 뒤 유예 중인 노드 -> 만료 처리 태스크. 재접속 핸드셰이크 중(송신 큐 설치 전)이면 None
+suspended_sessions: Dict[str, Optional[asyncio.Task]] = {}
+memory_sessions: Dict[str, Dict] = {}  # memory 백엔드용 node_id -> {"token", "state"}
+memory_session_buffers: Dict[str, deque] = {}
+
+
+async def open_session(node_id: str, resume_token: Optional[str]) -> Tuple[str, bool]:
+    """resume_token 이 유효하면 기존 세션을 이어받습니다. 어느 쪽이든 새 토큰을 발급해 반환합니다."""
+    new_token = secrets.token_urlsafe(16)
+    expiry_task = suspended_sessions.get(node_id)
+    if expiry_task is not None:
+        expiry_task.cancel()
+    # 송신 큐가 설치될 때까지(activate_connection) 들어오는 릴레이 메시지는 유예 중처럼 버퍼에 모음
+    suspended_sessions[node_id] = None
+    if USE_REDIS:
+        stored, previous_worker = await redis_client.hmget(f"session:{node_id}", ["token", "worker"])
+        resumed = bool(resume_token) and stored == resume_token
+        if previous_worker and previous_worker != WORKER_ID:
+            # 이전 워커가 유예 중인 세션을 계속 로컬 버퍼로 잡고 있지 않도록 알림
+            await redis_client.publish(worker_channel(previous_worker),
+                                       json.dumps({"control": "session_taken", "node_id": node_id}))
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(f"session:{node_id}", mapping={"token": new_token, "state": "active", "worker": WORKER_ID})
+        pipe.persist(f"session:{node_id}")
+        if not resumed:
+            # 새 세션이면 이전 버퍼는 버리고, 첫 GPS 에 바로 그룹 스냅샷이 가도록 함
+            pipe.delete(f"session_buf:{node_id}")
+            pipe.hdel(f"peer:{node_id}", "coords_at")
+        await execute_pipeline(pipe)
+    else:
+        stored = memory_sessions.get(node_id, {}).get("token")
+        resumed = bool(resume_token) and stored == resume_token
+        memory_sessions[node_id] = {"token": new_token, "state": "active"}
+        if not resumed:
+            memory_session_buffers.pop(node_id, None)
+            memory_backend.coords_at.pop(node_id, None)
+    if not resumed:
+        # 정지 차량 필터가 첫 GPS 를 걸러내면 새 세션은 그룹을 받을 때까지 오래 기다리게 됨
+        last_evaluated.pop(node_id, None)
+    return new_token, resumed
+
+
+async def buffer_session_message(node_id: str, payload: Dict):
+    if not USE_REDIS:
+        memory_session_buffers.setdefault(node_id, deque(maxlen=SESSION_BUFFER_MAX)).append(payload)
+        return
+    key = f"session_buf:{node_id}"
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.rpush(key, json.dumps(payload))
+    pipe.ltrim(key, -SESSION_BUFFER_MAX, -1)
+    pipe.expire(key, int(SESSION_GRACE_S) + 1)
+    await execute_pipeline(pipe)
+
+
+async def take_session_buffer(node_id: str) -> List[Dict]:
+    if not USE_REDIS:
+        return list(memory_session_buffers.pop(node_id, ()))
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.lrange(f"session_buf:{node_id}", 0, -1)
+    pipe.delete(f"session_buf:{node_id}")
+    buffered, _ = await execute_pipeline(pipe)
+    return [json.loads(item) for item in buffered]
+
+
+async def send_group_snapshot(node_id: str):
+    """재개된 세션에 현재 그룹 전체(좌표 포함)를 보내 유예 중 바뀐 멤버십을 맞춥니다."""
+    node_ids = [node_id] + await get_group_ids(node_id)
+    if USE_REDIS:
+        positions = await geo_index.positions(node_ids)
+        members = [{"node_id": n, "location": positions[n]} for n in node_ids if n in positions]
+    else:
+        positions = memory_backend.grid.positions
+        members = [{"node_id": n, "location": positions[n]} for n in node_ids if n in positions]
+    await send_local(node_id, {"type": "group_update", "data": members})
+
+
+async def flush_session_buffer(node_id: str) -> int:
+    buffered = await take_session_buffer(node_id)
+    for payload in buffered:
+        await send_local(node_id, payload)
+    return len(buffered)
+
+
+async def resume_session(node_id: str):
+    flushed = await flush_session_buffer(node_id)
+    await send_group_snapshot(node_id)
+    print(f"🔁 세션 재개: {node_id} (버퍼 메시지 {flushed}건 재전송)")
+
+
+async def cleanup_node(node_id: str):
+    """차량을 그룹/위치 인덱스/레지스트리에서 완전히 제거합니다."""
+    if USE_REDIS:
+        await geo_index.remove([node_id])
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrem(LAST_SEEN_KEY, node_id)
+        pipe.delete(f"peer:{node_id}", f"session:{node_id}", f"session_buf:{node_id}")
+        await execute_pipeline(pipe)
+    else:
+        memory_sessions.pop(node_id, None)
+        memory_session_buffers.pop(node_id, None)
+    await remove_node_from_groups(node_id)
+    await unregister_node(node_id)
+    last_evaluated.pop(node_id, None)
+    motion_state.pop(node_id, None)
+
+
+async def expire_session(node_id: str):
+    await asyncio.sleep(SESSION_GRACE_S)
+    suspended_sessions.pop(node_id, None)
+    if USE_REDIS:
+        # 그 사이 다른 워커에서 재개됐으면 정리하지 않음
+        session = await redis_client.hgetall(f"session:{node_id}")
+        if session and (session.get("state") != "suspended" or session.get("worker") != WORKER_ID):
+            return
+    elif memory_sessions.get(node_id, {}).get("state") != "suspended":
+        return
+    await cleanup_node(node_id)
+    print(f"❌ 세션 만료: {node_id} (총 {len(active_connections)}대)")
+
+
+async def suspend_session(node_id: str):
+    """연결 종료 시 바로 지우지 않고 SESSION_GRACE_S 동안 그룹 상태와 레지스트리를 유지합니다."""
+    if SESSION_GRACE_S <= 0:
+        await cleanup_node(node_id)
+        return
+    if USE_REDIS:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(f"session:{node_id}", mapping={"state": "suspended", "worker": WORKER_ID})
+        pipe.expire(f"session:{node_id}", int(SESSION_GRACE_S) * 2)
+        await execute_pipeline(pipe)
+    elif node_id in memory_sessions:
+        memory_sessions[node_id]["state"] = "suspended"
+    suspended_sessions[node_id] = asyncio.create_task(expire_session(node_id))
+
+
+# --- 웜 재시작 ---
+server_started_at = time.time()
+warm_nodes: set = set()  # memory 백엔드: 스냅샷에서 복원한, 아직 재접속하지 않은 노드
+
+
+class AdmissionPacer:
+    """토큰 버킷으로 접속 수락 속도를 제한합니다. 거절한 연결에는 밀린 정도에 비례하고
+    지터를 섞은 재시도 시간을 주어 재접속이 한 시점에 다시 몰리지 않게 합니다."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.waiting = 0.0  # 재시도를 안내한 연결 수 (rate 속도로 감소)
+        self.updated = time.monotonic()
+
+    def try_admit(self) -> Optional[float]:
+        """수락하면 None, 아니면 권장 재시도 시간(초)."""
+        if self.rate <= 0:
+            return None
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.waiting = max(0.0, self.waiting - elapsed * self.rate)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        self.waiting += 1
+        retry_after = self.waiting / self.rate * random.uniform(0.5, 1.5) + random.uniform(0, 1)
+        return min(retry_after, ADMISSION_MAX_RETRY_S)
+
+
+admission = AdmissionPacer(ADMISSION_RATE, ADMISSION_BURST)
+
+
+async def claim_warm_node(node_id: str) -> bool:
+    """재시작 전에 접속 중이던 노드의 첫 재접속이면 True (한 번만)."""
+    if USE_REDIS:
+        return bool(await redis_client.srem(WARM_NODES_KEY, node_id))
+    if node_id in warm_nodes:
+        warm_nodes.discard(node_id)
+        return True
+    return False
+
+
+def build_memory_snapshot() -> Dict:
+    return {
+        "saved_at": time.time(),
+        "positions": memory_backend.grid.positions,
+        "groups": {node_id: list(current) for node_id, current in memory_backend.groups.items() if current},
+        "sessions": {node_id: session["token"] for node_id, session in memory_sessions.items()},
+        "nodes": list(set(active_connections) | set(suspended_sessions)),
+    }
+
+
+def write_snapshot_file(snapshot: Dict):
+    tmp_path = f"{WARM_SNAPSHOT_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, WARM_SNAPSHOT_PATH)
+
+
+async def save_warm_state():
+    """종료 직전 상태를 남깁니다. Redis 백엔드는 그룹/위치가 이미 Redis 에 있으므로 세션만 유예 상태로 바꿈."""
+    nodes = list(set(active_connections) | set(suspended_sessions))
+    if not USE_REDIS:
+        write_snapshot_file(build_memory_snapshot())
+        print(f"💾 웜 재시작 스냅샷 저장: 차량 {len(memory_backend.grid)}대 -> {WARM_SNAPSHOT_PATH}")
+        return
+    if not nodes:
+        return
+    ttl = int(WARM_RESTART_GRACE_S + SESSION_GRACE_S)
+    pipe = redis_client.pipeline(transaction=False)
+    for node_id in nodes:
+        pipe.hset(f"session:{node_id}", mapping={"state": "suspended", "worker": WORKER_ID})
+        pipe.expire(f"session:{node_id}", ttl)
+    pipe.sadd(WARM_NODES_KEY, *nodes)
+    pipe.expire(WARM_NODES_KEY, ttl)
+    await execute_pipeline(pipe)
+    print(f"💾 웜 재시작 정보 저장: 차량 {len(nodes)}대")
+
+
+def restore_memory_snapshot():
+    """memory 백엔드: 최근 스냅샷이 있으면 위치/그룹/세션 토큰을 복원합니다."""
+    try:
+        with open(WARM_SNAPSHOT_PATH) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return
+    age = time.time() - snapshot.get("saved_at", 0)
+    if age > WARM_SNAPSHOT_MAX_AGE_S:
+        print(f"⚠️ 웜 재시작 스냅샷이 오래되어 무시합니다 ({age:.0f}초 전)")
+        return
+    now = time.time()
+    for node_id, (lat, lon) in snapshot.get("positions", {}).items():
+        memory_backend.grid.update(node_id, lat, lon)
+        memory_backend.touch(node_id, now)  # 재접속할 시간을 주기 위해 last_seen 을 지금으로
+    memory_backend.groups = {node_id: set(current) for node_id, current in snapshot.get("groups", {}).items()}
+    for node_id, token in snapshot.get("sessions", {}).items():
+        memory_sessions[node_id] = {"token": token, "state": "suspended"}
+    warm_nodes.update(snapshot.get("nodes", []))
+    print(f"♻️ 웜 재시작: 차량 {len(memory_backend.grid)}대, 그룹 {len(memory_backend.groups)}개 복원"
+          f" ({age:.0f}초 전 스냅샷)")
+
+
+async def memory_snapshot_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(WARM_SNAPSHOT_INTERVAL_S)
+        try:
+            # 직렬화/쓰기는 이벤트 루프 밖에서 (스냅샷 dict 는 루프에서 만들어 일관성 유지)
+            snapshot = build_memory_snapshot()
+            snapshot["positions"] = dict(snapshot["positions"])
+            await loop.run_in_executor(None, write_snapshot_file, snapshot)
+        except Exception as e:
+            print(f"⚠️ 웜 재시작 스냅샷 저장 실패: {e}")
+
+
+# --- 유령 차량 정리(reaper) ---
+reaper_counters = {"sweeps": 0, "evicted": 0, "last_sweep_evicted": 0, "last_sweep_ms": 0.0}
+
+
+async def evict_nodes(node_ids: List[str]):
+    """만료된 노드들을 geo 집합/인덱스/peer 해시/레지스트리에서 한 번에 지우고 이웃에게 leave 를 알립니다."""
+    if USE_REDIS:
+        await geo_index.remove(node_ids)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrem(LAST_SEEN_KEY, *node_ids)
+        pipe.hdel(NODE_WORKER_KEY, *node_ids)
+        pipe.delete(*[f"peer:{n}" for n in node_ids])
+        pipe.delete(*[f"session:{n}" for n in node_ids], *[f"session_buf:{n}" for n in node_ids])
+        await execute_pipeline(pipe)
+    else:
+        for ghost_id in node_ids:
+            memory_sessions.pop(ghost_id, None)
+            memory_session_buffers.pop(ghost_id, None)
+    for ghost_id in node_ids:
+        await remove_node_from_groups(ghost_id)
+        last_evaluated.pop(ghost_id, None)
+        motion_state.pop(ghost_id, None)
+
+
+async def reap_stale_vehicles() -> int:
+    """last_seen 이 TTL 을 넘긴 노드를 배치 단위로 제거합니다. 한 sweep 의 비용은 배치 수로 제한."""
+    cutoff = time.time() - VEHICLE_TTL_S
+    evicted = 0
+    for _ in range(REAPER_MAX_BATCHES):
+        if USE_REDIS:
+            expired = await redis_client.zrangebyscore(LAST_SEEN_KEY, "-inf", cutoff,
+                                                       start=0, num=REAPER_BATCH_SIZE)
+        else:
+            expired = memory_backend.expired(cutoff, REAPER_BATCH_SIZE)
+        # 이 워커에 아직 살아 있는 소켓은 건드리지 않음 (last_seen 만 늦은 경우)
+        expired = [n for n in expired if n not in active_connections and n not in suspended_sessions]
+        if not expired:
+            break
+        await evict_nodes(expired)
+        evicted += len(expired)
+        if len(expired) < REAPER_BATCH_SIZE:
+            break
+    return evicted
+
+
+async def stale_vehicle_reaper():
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL_S)
+        if time.time() - server_started_at < WARM_RESTART_GRACE_S:
+            continue  # 재시작 직후에는 재접속 중인 차량을 유령으로 지우지 않음
+        try:
+            # 여러 워커 중 한 곳만 sweep 하도록 짧은 락을 사용
+            if USE_REDIS and not await redis_client.set("reaper_lock", WORKER_ID, nx=True,
+                                                        ex=max(1, int(REAPER_INTERVAL_S))):
+                continue
+            started = time.perf_counter()
+            evicted = await reap_stale_vehicles()
+            reaper_counters["sweeps"] += 1
+            reaper_counters["evicted"] += evicted
+            reaper_counters["last_sweep_evicted"] = evicted
+            reaper_counters["last_sweep_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            if USE_REDIS:
+                await redis_client.hset(f"stats:reaper:{WORKER_ID}", mapping=reaper_counters)
+            if evicted:
+                print(f"🧹 유령 차량 {evicted}대 정리 (누적 {reaper_counters['evicted']}대,"
+                      f" {reaper_counters['last_sweep_ms']}ms)")
+        except Exception as e:
+            print(f"⚠️ 유령 차량 정리 실패: {e}")
+
+
 # --- 서버 측 Pub/Sub 리스너 ---
 async def group_update_listener():
+    # worker:{WORKER_ID} 로 이 워커가 가진 소켓으로 향하는 그룹 메시지/릴레이/시그널링만 받음
     pubsub = redis_client.pubsub()
-    await pubsub.subscribe("group_updates")
-    print("📢 그룹 업데이트 리스너 시작됨.")
+    my_channel = worker_channel(WORKER_ID)
+    await pubsub.subscribe(my_channel)
+    print(f"📢 그룹 업데이트 리스너 시작됨. (워커: {WORKER_ID})")
     async for message in pubsub.listen():
-        if message["type"] == "message":
-            update_info = json.loads(message["data"])
-            group_members_list = update_info.get("group_members", [])
-            for member in group_members_list:
-                node_id = member["node_id"]
-                if node_id in active_connections:
-                    conn = active_connections[node_id]
-                    try:
-                        await conn.send_json({"type": "group_update", "data": group_members_list})
-                    except Exception:
-                        pass
+        if message["type"] != "message":
+            continue
+        try:
+            routed = json.loads(message["data"])
+            if routed.get("control") == "session_taken":
+                expiry_task = suspended_sessions.pop(routed["node_id"], None)
+                if expiry_task is not None:
+                    expiry_task.cancel()
+                continue
+            if "messages" in routed:
+                await deliver_local_group_messages(routed["messages"])
+                continue
+            frame_cache = {}
+            for target_id in routed.get("targets", []):
+                await send_local(target_id, routed["payload"], frame_cache)
+        except Exception as e:
+            print(f"⚠️ Pub/Sub 메시지 처리 실패: {e}")
 
 
 @app.on_event("startup")
 async def startup_event():
     # await redis_client.flushdb() # 운영 환경에서는 주석 처리
-    asyncio.create_task(group_update_listener())
-    print("✅ 서버가 시작되었습니다.")
+    if USE_REDIS:
+        asyncio.create_task(group_update_listener())
+    else:
+        if SERVER_WORKERS > 1:
+            print("⚠️ memory 백엔드는 워커 간 상태를 공유하지 않습니다. SERVER_WORKERS=1 로 실행하세요.")
+        if WARM_SNAPSHOT_PATH:
+            restore_memory_snapshot()
+            asyncio.create_task(memory_snapshot_writer())
+    asyncio.create_task(ingest_stats_reporter())
+    asyncio.create_task(stale_vehicle_reaper())
+    asyncio.create_task(event_loop_lag_monitor())
+    if CAPTURE_PATH:
+        start_capture()
+    if GROUP_SCHEDULER == "tick":
+        asyncio.create_task(group_tick_loop())
+    if USE_REDIS and geo_index.partitioned:
+        print(f"🗺️ 위치 인덱스 지역 분할: geohash {GEO_PARTITION_PRECISION}자리,"
+              f" Redis {len(geo_index.shards)}개{' (Lua ingest 대신 순차 경로)' if geo_index.sharded else ''}")
+    print(f"✅ 서버가 시작되었습니다. (워커: {WORKER_ID}, 그룹핑 백엔드: {GROUPING_BACKEND})")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if (USE_REDIS and WARM_RESTART_GRACE_S > 0) or (not USE_REDIS and WARM_SNAPSHOT_PATH):
+        try:
+            await save_warm_state()
+        except Exception as e:
+            print(f"⚠️ 웜 재시작 정보 저장 실패: {e}")
+    if capture is not None:
+        capture.close()
+
+
+# --- 트래픽 캡처 ---
+def start_capture():
+    global capture
+    path = capture_path_for_worker(CAPTURE_PATH, WORKER_ID, SERVER_WORKERS)
+    capture = TrafficCapture(path)
+    asyncio.create_task(capture_flusher())
+    print(f"🎥 트래픽 캡처 중: {path}")
+
+
+async def capture_flusher():
+    while True:
+        await asyncio.sleep(CAPTURE_FLUSH_S)
+        capture.flush()
+
+
+# --- 메트릭 ---
+async def event_loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_S)
+        lag = max(0.0, (loop.time() - started - LOOP_LAG_INTERVAL_S) * 1000)
+        loop_lag_ms.observe(lag)
+        loop_lag_last.set(round(lag, 3))
+
+
+def refresh_scrape_gauges():
+    """스크랩 시점에 계산하는 값: 연결별 송신 큐 깊이 요약과 연결 수, 기존 카운터들."""
+    depths = sorted(len(writer.queue) for writer in connection_writers.values())
+    for stat, p in (("p50", 0.5), ("p99", 0.99)):
+        queue_depth.set(percentile(depths, p), stat)
+    queue_depth.set(depths[-1] if depths else 0, "max")
+    queue_depth.set(sum(depths), "sum")
+    connections_gauge.set(len(active_connections), "active")
+    connections_gauge.set(len(suspended_sessions), "suspended")
+
+
+def legacy_counters() -> Dict:
+    return {"ingest": ingest_counters, "outbound": outbound_counters, "reaper": reaper_counters,
+            "tick": tick_counters, "dropped_by_type": dropped_by_type}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    refresh_scrape_gauges()
+    lines = [metrics.render_prometheus()]
+    for group, counters in legacy_counters().items():
+        for key, value in counters.items():
+            if isinstance(value, (int, float)):
+                lines.append(f'relay_{group}{{name="{key}"}} {value}\n')
+    return PlainTextResponse("".join(lines))
+
+
+@app.get("/metrics.json")
+async def metrics_json_endpoint():
+    refresh_scrape_gauges()
+    return JSONResponse({"worker": WORKER_ID, **metrics.as_dict(), **legacy_counters()})
 
 
 # --- 서버 측 웹소켓 엔드포인트 ---
 @app.websocket("/ws/{node_id}")
 async def websocket_endpoint(websocket: WebSocket, node_id: str):
     await websocket.accept()
+    retry_after = admission.try_admit()
+    if retry_after is not None:
+        admission_rejected.inc()
+        await websocket.send_text(json.dumps({"type": "retry_later", "retry_after_s": round(retry_after, 2)}))
+        await websocket.close(code=1013)
+        return
+    if capture is not None:
+        capture.record(KIND_OPEN, node_id, str(websocket.query_params))
+    # 인코딩 협상: /ws/{node_id}?encoding=msgpack. 결과는 hello 메시지(JSON)로 알려줌
+    encoding = message_codec.negotiate(websocket.query_params.get("encoding"))
+    try:
+        # 세션 재개: /ws/{node_id}?resume=<hello 로 받은 토큰>
+        resume_token, resumed = await open_session(node_id, websocket.query_params.get("resume"))
+        # 웜 재시작 후 첫 접속이면 토큰이 없어도 이전 그룹을 바로 돌려주고, 클라이언트는 기존 피어를 유지
+        warm = await claim_warm_node(node_id)
+        hello = json.dumps({"type": "hello", "encoding": encoding,
+                            "resume_token": resume_token, "resumed": resumed, "warm": warm})
+        await websocket.send_text(hello)
+    except Exception as e:
+        # 핸드셰이크 중 끊기면 일반 연결 종료처럼 유예 상태로 둠 (None 자리표시가 남지 않도록)
+        print(f"⚠️ 차량 연결 핸드셰이크 실패: {node_id} ({e})")
+        if node_id not in active_connections:
+            suspended_sessions.pop(node_id, None)
+            await suspend_session(node_id)
+        return
+    if capture is not None:
+        capture.record(KIND_OUT, node_id, hello)
+    previous_writer = connection_writers.get(node_id)
+    if previous_writer is not None:
+        previous_writer.close()
     active_connections[node_id] = websocket
-    print(f"✅ 차량 연결됨: {node_id} (총 {len(active_connections)}대)")
+    connection_writers[node_id] = ConnectionWriter(node_id, websocket, encoding)
+    suspended_sessions.pop(node_id, None)  # 이제부터는 송신 큐로 바로 전달
+    await register_node(node_id)
+    print(f"✅ 차량 연결됨: {node_id} (워커 {WORKER_ID}, 인코딩 {encoding}, 총 {len(active_connections)}대)")
+    if resumed:
+        await resume_session(node_id)
+    else:
+        # 핸드셰이크 중 버퍼에 모인 릴레이 메시지
+        await flush_session_buffer(node_id)
+        if warm:
+            await send_group_snapshot(node_id)
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-
-            # P2P 릴레이 메시지 중계 로직
-            if message.get("type") == "p2p_relay":
-                target_id = message.get("target_id")
-                if target_id in active_connections:
-                    relay_payload = {
-                        "type": "p2p_message",
-                        "from_id": node_id,
-                        "content": message.get("content")
-                    }
-                    await active_connections[target_id].send_json(relay_payload)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            data = frame.get("bytes") if frame.get("bytes") is not None else frame.get("text")
+            if capture is not None:
+                capture.record(KIND_IN, node_id, data)
+            # 잘못된 메시지 하나 때문에 연결 정리 없이 끊기지 않도록 메시지 단위로 오류를 처리
+            try:
+                message = message_codec.decode(data)
+                if not isinstance(message, dict):
+                    raise ValueError(f"객체가 아닌 메시지: {type(message).__name__}")
+            except Exception as e:
+                messages_total.inc("in", "invalid")
+                print(f"⚠️ 잘못된 메시지 무시: {node_id} ({e})")
                 continue
+            inbound_type = message.get("type") or ("gps" if "latitude" in message else "unknown")
+            if inbound_type not in INBOUND_MESSAGE_TYPES:
+                inbound_type = "other"  # 클라이언트가 정한 값으로 메트릭 시리즈가 늘어나지 않도록
+            messages_total.inc("in", inbound_type)
+            bytes_total.inc("in", inbound_type, amount=frame_size(data))
+            try:
+                await handle_client_message(node_id, websocket, message)
+            except Exception as e:
+                print(f"⚠️ 메시지 처리 실패: {node_id} {inbound_type} ({e})")
 
-            # P2P 홀 펀칭 시그널링 메시지 중계 로직
-            if message.get("type") in ["p2p_request", "p2p_response"]:
-                target_id = message.get("target_id")
-                if target_id in active_connections:
-                    message["ip"] = websocket.client.host
-                    await active_connections[target_id].send_json(message)
-                continue
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"⚠️ 차량 연결 오류: {node_id} ({e})")
+    if capture is not None:
+        capture.record(KIND_CLOSE, node_id)
+    # 같은 node_id 로 이미 새 연결이 들어온 경우에는 아무것도 정리하지 않음
+    if active_connections.get(node_id) is websocket:
+        del active_connections[node_id]
+        connection_writers.pop(node_id).close()
+        await suspend_session(node_id)
+        print(f"⏸️ 차량 연결 끊김: {node_id} ({SESSION_GRACE_S:.0f}초 동안 재개 대기, 총 {len(active_connections)}대)")
 
-            # GPS 위치 업데이트 로직
-            if "latitude" in message and "longitude" in message:
-                loc_tuple = (message["latitude"], message["longitude"])
-                await redis_client.hset(f"peer:{node_id}", mapping={
-                    "node_id": node_id, "location": f"{loc_tuple[0]},{loc_tuple[1]}",
-                    "last_seen": time.time()
-                })
-                group_members = await update_and_get_group(node_id, loc_tuple)
-                await redis_client.publish("group_updates", json.dumps({"group_members": group_members}))
 
-    except WebSocketDisconnect:
-        await redis_client.zrem("vehicles", node_id)
-        await redis_client.delete(f"peer:{node_id}")
-        if node_id in active_connections:
-            del active_connections[node_id]
-        print(f"❌ 차량 연결 끊김: {node_id} (총 {len(active_connections)}대)")
\ No newline at end of file
+async def handle_client_message(node_id: str, websocket: WebSocket, message: Dict):
+    # P2P 릴레이 메시지 중계 로직
+    if message.get("type") == "p2p_relay":
+        target_id = message.get("target_id")
+        if target_id:
+            relay_payload = {
+                "type": "p2p_message",
+                "from_id": node_id,
+                "content": message.get("content")
+            }
+            await route_to_nodes([target_id], relay_payload)
+        return
+
+    # 그룹 팬아웃: 클라이언트는 한 번만 보내고 서버가 현재 그룹 멤버들에게 복제
+    if message.get("type") == "group_relay":
+        exclude = set(message.get("exclude") or [])
+        exclude.add(node_id)
+        targets = [t for t in await get_group_ids(node_id) if t not in exclude]
+        if targets:
+            relay_payload = {
+                "type": "p2p_message",
+                "from_id": node_id,
+                "content": message.get("content")
+            }
+            await route_to_nodes(targets, relay_payload)
+        return
+
+    # 위치 기반 경고 방송: 경고 좌표 주변의 모든 차량 (보낸 차량의 그룹 밖 포함)
+    if message.get("type") == "geo_broadcast":
+        await handle_geo_broadcast(node_id, message)
+        return
+
+    # P2P 홀 펀칭 시그널링 메시지 중계 로직
+    if message.get("type") in ["p2p_request", "p2p_response"]:
+        target_id = message.get("target_id")
+        if target_id:
+            message["ip"] = websocket.client.host
+            await route_to_nodes([target_id], message)
+        return
+
+    # GPS 위치 업데이트 로직
+    if "latitude" in message and "longitude" in message:
+        loc_tuple = parse_gps_fix(message)
+        if loc_tuple is None:
+            ingest_counters["invalid"] += 1
+            return
+        await handle_gps_fix(node_id, loc_tuple)
+
+
+if __name__ == "__main__":
+    # 코어 수만큼 워커를 띄우려면: SERVER_WORKERS=4 python main.py
+    # 여러 호스트로 나누는 경우 각 호스트가 같은 REDIS_URL 을 바라보면 됨
+    import uvicorn
+    uvicorn.run("main:app", host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS)
@@ -0,0 +1,53 @@
+# message_codec.py (main.py <-> p2p_client.py 웹소켓 메시지 인코딩)
+# - json: 기존 텍스트 프레임
+# - msgpack: 바이너리 프레임. GPS 위치는 고정 struct(17바이트)로, 나머지는 MessagePack 으로 인코딩
+# 수신 측은 프레임 종류(텍스트/바이너리)만 보고 디코딩하므로 두 방식이 한 연결에 섞여도 됩니다.
+import json
+import struct
+from typing import Dict, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+# 태그(0x01) + 위도 + 경도. MessagePack 맵은 0x80 이상으로 시작하므로 첫 바이트로 구분됨
+GPS_FRAME_TAG = 0x01
+GPS_FRAME = struct.Struct("<Bdd")
+
+
+def supported_encodings():
+    return [ENCODING_JSON, ENCODING_MSGPACK] if msgpack is not None else [ENCODING_JSON]
+
+
+def negotiate(requested: Optional[str]) -> str:
+    """클라이언트가 요청한 인코딩을 쓸 수 있으면 그대로, 아니면 json 을 반환합니다."""
+    if requested in supported_encodings():
+        return requested
+    return ENCODING_JSON
+
+
+def is_plain_gps(message: Dict) -> bool:
+    return message.keys() == {"latitude", "longitude"}
+
+
+def encode(message: Dict, encoding: str = ENCODING_JSON) -> Union[str, bytes]:
+    if encoding != ENCODING_MSGPACK or msgpack is None:
+        return json.dumps(message)
+    if is_plain_gps(message):
+        return GPS_FRAME.pack(GPS_FRAME_TAG, float(message["latitude"]), float(message["longitude"]))
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def decode(data: Union[str, bytes, bytearray]) -> Dict:
+    if isinstance(data, str):
+        return json.loads(data)
+    if len(data) == GPS_FRAME.size and data[0] == GPS_FRAME_TAG:
+        _, lat, lon = GPS_FRAME.unpack(data)
+        return {"latitude": lat, "longitude": lon}
+    if msgpack is None:
+        raise ValueError("msgpack 이 설치되어 있지 않아 바이너리 프레임을 디코딩할 수 없습니다.")
+    return msgpack.unpackb(data, raw=False)
@@ -1,5 +1,7 @@
 import asyncio
+import heapq
 import json
+import math
 import random
 import argparse
 import aiohttp
@@ -8,9 +10,13 @@ import socket
 import atexit
 import time
 import os
-import re  # 정규 표현식 사용
+import uuid
 import tts  # ⭐️ [1/4 추가] TTS 모듈 임포트
-from typing import Dict, Tuple
+import message_codec
+import p2p_datagram
+from p2p_reliable import ReliableChannel
+from geo_utils import haversine_m
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 
 # .env 파일에서 환경 변수를 로드
@@ -24,12 +30,318 @@ unity_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 # --- gps_service.py 주소 설정 ---
 GPS_SERVICE_URL = os.getenv("GPS_SERVICE_URL", "http://localhost:8000")  # .env 또는 기본값
+PIN_BATCH_WINDOW_S = 0.3  # 이 시간 동안 들어온 경고 핀은 한 번의 요청(/add_temp_pins)으로 묶음
+
+# --- 메인 서버와의 웹소켓 인코딩 (json | msgpack) ---
+WS_ENCODING = os.getenv("WS_ENCODING", message_codec.ENCODING_JSON)
+
+# --- 재접속 설정: 서버의 세션 유예 시간 안에 재개할 수 있도록 처음엔 빠르게 재시도 ---
+RECONNECT_DELAY_MIN_S = 1.0
+RECONNECT_DELAY_MAX_S = 5.0
+
+# --- 피어별 직접 경로(UDP) 상태: 최근 직접 수신으로 확인된 피어에게는 서버 릴레이 사본을 보내지 않음 ---
+P2P_HEARTBEAT_INTERVAL_S = 5.0  # 피어가 적을 때의 하트비트 주기 (최근 수신이 있으면 생략)
+HEARTBEAT_MAX_PER_S = float(os.getenv("HEARTBEAT_MAX_PER_S", "20"))  # 피어가 많으면 주기를 늘려 이 속도로 제한
+HEARTBEAT_TICK_S = 0.1  # 하트비트 스케줄 확인 간격 (주기 안에 고르게 흩어 보냄)
+PATH_ACK_TIMEOUT_S = 12.0  # 하트비트를 보낸 뒤 이 시간 안에 응답이 없으면 직접 경로 실패
+PATH_FAILURE_HOLD_S = 15.0  # 실패 후 이 시간 동안은 응답이 다시 와도 릴레이를 함께 사용
+RELIABILITY_REPORT_S = 60.0  # 경고 전달 지연/재전송 통계 출력 주기
+
+# --- GPS 업링크: 의미 있게 움직이거나 방향이 바뀔 때만 즉시 전송, 아니면 느린 keep-alive ---
+UPLINK_MIN_MOVE_M = float(os.getenv("UPLINK_MIN_MOVE_M", "5"))
+UPLINK_MIN_HEADING_DEG = float(os.getenv("UPLINK_MIN_HEADING_DEG", "15"))
+UPLINK_COURSE_MIN_STEP_M = 10.0  # 진행 방향은 GPS 잡음(수 m)보다 충분히 긴 이동으로만 계산 (정지 차량 오탐 방지)
+UPLINK_TURN_MIN_SPEED_MPS = 1.5  # GPS 가 준 heading 도 이 속도 이상일 때만 사용 (speed 가 있을 때)
+UPLINK_KEEPALIVE_S = float(os.getenv("UPLINK_KEEPALIVE_S", "15"))  # 서버 VEHICLE_TTL_S(60초)보다 충분히 짧게
+
+# --- 이벤트 루프 지연 측정 (TTS 같은 블로킹 호출이 루프를 멈추는지 확인용) ---
+LOOP_LAG_INTERVAL_S = 0.25
+loop_lag_stats = {"samples": 0, "last_ms": 0.0, "max_ms": 0.0, "over_100ms": 0}
+
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_S)
+        lag_ms = max(0.0, (loop.time() - started - LOOP_LAG_INTERVAL_S) * 1000)
+        loop_lag_stats["samples"] += 1
+        loop_lag_stats["last_ms"] = round(lag_ms, 2)
+        loop_lag_stats["max_ms"] = round(max(loop_lag_stats["max_ms"], lag_ms), 2)
+        if lag_ms > 100:
+            loop_lag_stats["over_100ms"] += 1
+
+
+class PeerTable:
+    """홀 펀칭된 피어별 주소, 마지막 수신 시각, RTT, 직접 경로 상태, 위치를 관리합니다.
+
+    하트비트는 피어마다 임의 위상으로 흩어 보내고, 그 피어에게서 최근에 무엇이든 받았으면 생략합니다.
+    초당 하트비트 수는 HEARTBEAT_MAX_PER_S 로 제한해 그룹이 커지면 주기가 길어집니다.
+    """
+
+    def __init__(self):
+        self.peers: Dict[str, Dict] = {}
+        self.schedule: List[Tuple[float, str]] = []  # (다음 하트비트 시각, peer_id) 힙. 갱신 시 이전 항목은 무시
+        self.stats = {"heartbeats_sent": 0, "heartbeats_suppressed": 0}
+
+    # --- 주소 (dict 처럼 peer_id -> (ip, port) 로 사용) ---
+    def __contains__(self, peer_id) -> bool:
+        return peer_id in self.peers
+
+    def __iter__(self):
+        return iter(list(self.peers))
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+    def __getitem__(self, peer_id: str) -> Tuple[str, int]:
+        return self.peers[peer_id]["addr"]
+
+    def get(self, peer_id: str) -> Optional[Tuple[str, int]]:
+        peer = self.peers.get(peer_id)
+        return peer["addr"] if peer else None
+
+    def items(self):
+        return [(peer_id, peer["addr"]) for peer_id, peer in self.peers.items()]
+
+    def add(self, peer_id: str, addr: Tuple[str, int], now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        peer = self.peers.get(peer_id)
+        if peer is not None:
+            if peer["addr"] != addr:
+                # 재접속/셀 이동으로 새 주소에서 다시 펀칭: 새 경로는 검증 전이므로 상태를 지우고 바로 확인
+                peer.update(addr=addr, last_seen=None, rtt_ms=None, unacked_since=None, failed_at=None)
+                self._schedule(peer_id, now)
+            return
+        self.peers[peer_id] = {"addr": addr, "last_seen": None, "rtt_ms": None, "unacked_since": None,
+                               "failed_at": None, "position": None, "next_heartbeat_at": None}
+        # 같은 group_update 로 한꺼번에 들어온 피어들도 주기 안에 고르게 흩어지도록 임의 위상
+        self._schedule(peer_id, now + random.uniform(0, self.heartbeat_interval))
+
+    def remove(self, peer_id: str) -> bool:
+        return self.peers.pop(peer_id, None) is not None
+
+    def retain(self, peer_ids) -> List[str]:
+        removed = [p for p in self.peers if p not in peer_ids]
+        for peer_id in removed:
+            del self.peers[peer_id]
+        return removed
+
+    def clear(self):
+        self.peers.clear()
+        self.schedule.clear()
+
+    # --- 수신 / 경로 상태 ---
+    def seen(self, peer_id: str, now: float, position: Optional[Tuple[float, float]] = None):
+        """피어에게서 직접(UDP) 무엇이든 받으면 경로가 살아 있는 것으로 봅니다 (하트비트 대신)."""
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            return
+        peer["last_seen"] = now
+        peer["unacked_since"] = None
+        if position is not None:
+            peer["position"] = position
+
+    def set_position(self, peer_id: str, position):
+        peer = self.peers.get(peer_id)
+        if peer is not None and position:
+            peer["position"] = tuple(position)
+
+    def heartbeat_sent(self, peer_id: str, now: float):
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            return
+        if peer["unacked_since"] is None:
+            peer["unacked_since"] = now
+        self.stats["heartbeats_sent"] += 1
+
+    def ack_received(self, peer_id: str, sent_at: float, now: float):
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            return
+        rtt_ms = (now - sent_at) * 1000
+        peer["rtt_ms"] = rtt_ms if peer["rtt_ms"] is None else 0.8 * peer["rtt_ms"] + 0.2 * rtt_ms
+        self.seen(peer_id, now)
+
+    def rtt_ms(self, peer_id: str) -> Optional[float]:
+        peer = self.peers.get(peer_id)
+        return peer["rtt_ms"] if peer else None
+
+    def check_timeouts(self, now: float) -> List[str]:
+        """하트비트 후 PATH_ACK_TIMEOUT_S 동안 아무것도 받지 못한 피어를 실패로 표시하고 목록을 반환합니다."""
+        failed = []
+        for peer_id, peer in self.peers.items():
+            if peer["unacked_since"] is not None and now - peer["unacked_since"] > PATH_ACK_TIMEOUT_S:
+                peer["failed_at"] = now
+                peer["unacked_since"] = None
+                failed.append(peer_id)
+        return failed
+
+    def is_healthy(self, peer_id: str, now: Optional[float] = None) -> bool:
+        peer = self.peers.get(peer_id)
+        if peer is None or peer["last_seen"] is None:
+            return False  # 아직 검증되지 않은 경로
+        now = time.monotonic() if now is None else now
+        if peer["failed_at"] is not None and now - peer["failed_at"] < PATH_FAILURE_HOLD_S:
+            return False
+        return now - peer["last_seen"] <= self.heartbeat_interval + PATH_ACK_TIMEOUT_S
+
+    # --- 하트비트 스케줄 ---
+    @property
+    def heartbeat_interval(self) -> float:
+        return max(P2P_HEARTBEAT_INTERVAL_S, len(self.peers) / HEARTBEAT_MAX_PER_S)
+
+    def _jittered_interval(self) -> float:
+        return self.heartbeat_interval * random.uniform(0.9, 1.1)
+
+    def _schedule(self, peer_id: str, due: float):
+        self.peers[peer_id]["next_heartbeat_at"] = due
+        heapq.heappush(self.schedule, (due, peer_id))
+
+    def due_heartbeats(self, now: float) -> List[str]:
+        """지금 하트비트를 보내야 하는 피어. 최근 수신이 있는 피어는 그 시점 기준으로 다음 차례를 미룹니다."""
+        due = []
+        while self.schedule and self.schedule[0][0] <= now:
+            at, peer_id = heapq.heappop(self.schedule)
+            peer = self.peers.get(peer_id)
+            if peer is None or peer["next_heartbeat_at"] != at:
+                continue  # 제거됐거나 이미 다시 예약된 피어
+            if peer["last_seen"] is not None and now - peer["last_seen"] < self.heartbeat_interval \
+                    and peer["unacked_since"] is None:
+                self.stats["heartbeats_suppressed"] += 1
+                self._schedule(peer_id, peer["last_seen"] + self._jittered_interval())
+                continue
+            self._schedule(peer_id, now + self._jittered_interval())
+            due.append(peer_id)
+        if len(self.schedule) > 4 * len(self.peers) + 64:
+            # 무시할 항목이 쌓이면 살아 있는 예약만으로 힙을 다시 만듦
+            self.schedule = [(p["next_heartbeat_at"], peer_id) for peer_id, p in self.peers.items()
+                             if p["next_heartbeat_at"] is not None]
+            heapq.heapify(self.schedule)
+        return due
+
+    def summary(self, now: float) -> Dict:
+        return {peer_id: {"healthy": self.is_healthy(peer_id, now),
+                          "rtt_ms": round(peer["rtt_ms"], 2) if peer["rtt_ms"] is not None else None,
+                          "last_seen_s": round(now - peer["last_seen"], 1) if peer["last_seen"] is not None else None,
+                          "position": peer["position"]}
+                for peer_id, peer in self.peers.items()}
+
+
+def bearing_deg(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    dlon = math.radians(lon2 - lon1)
+    lat1, lat2 = math.radians(lat1), math.radians(lat2)
+    x = math.sin(dlon) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+class LocationUplink:
+    """서버로 보낼 GPS 좌표를 고릅니다. 이동/방향 변화가 크면 즉시, 정지 중이면 keep-alive 주기로만 전송."""
+
+    def __init__(self):
+        self.last_sent: Optional[Tuple[float, float]] = None
+        self.last_sent_at: Optional[float] = None
+        self.sent_course: Optional[float] = None
+        self.last_fix: Optional[Tuple[float, float]] = None
+        self.course: Optional[float] = None
+        self.stats = {"sent": 0, "moved": 0, "turned": 0, "keepalive": 0, "suppressed": 0, "dropped_stale": 0}
+
+    def reset(self):
+        """재접속 후 첫 좌표는 바로 보냅니다."""
+        self.last_sent = None
+        self.last_sent_at = None
+
+    def observe(self, location: Dict):
+        """진행 방향은 실제로 움직일 때만 갱신합니다. 정지 중에는 course 가 그대로라 "turned" 가 나오지 않음."""
+        position = (location.get('latitude', 0.0), location.get('longitude', 0.0))
+        heading, speed = location.get('heading'), location.get('speed')
+        if heading is not None and (speed is None or float(speed) >= UPLINK_TURN_MIN_SPEED_MPS):
+            self.course = float(heading) % 360
+        if self.last_fix is None:
+            self.last_fix = position
+        elif haversine_m(*self.last_fix, *position) >= UPLINK_COURSE_MIN_STEP_M:
+            if heading is None:
+                self.course = bearing_deg(*self.last_fix, *position)
+            self.last_fix = position
+
+    def reason_to_send(self, location: Dict, now: float) -> Optional[str]:
+        if self.last_sent is None:
+            return "moved"
+        position = (location.get('latitude', 0.0), location.get('longitude', 0.0))
+        if haversine_m(*self.last_sent, *position) >= UPLINK_MIN_MOVE_M:
+            return "moved"
+        if self.course is not None and self.sent_course is not None:
+            turn = abs((self.course - self.sent_course + 180) % 360 - 180)
+            if turn >= UPLINK_MIN_HEADING_DEG:
+                return "turned"
+        if now - self.last_sent_at >= UPLINK_KEEPALIVE_S:
+            return "keepalive"
+        return None
+
+    def sent(self, location: Dict, now: float, reason: str):
+        self.last_sent = (location.get('latitude', 0.0), location.get('longitude', 0.0))
+        self.last_sent_at = now
+        self.sent_course = self.course
+        self.stats["sent"] += 1
+        self.stats[reason] += 1
+
+    def wait_timeout(self, now: float) -> float:
+        """다음 keep-alive 까지 남은 시간 (새 좌표가 오면 그 전에 깨어남)."""
+        if self.last_sent_at is None:
+            return UPLINK_KEEPALIVE_S
+        return max(0.0, self.last_sent_at + UPLINK_KEEPALIVE_S - now)
+
+
+# --- 직접 수신(UDP)과 서버 릴레이 수신이 공유하는 P2P 메시지 처리 ---
+def handle_p2p_message(node_id: str, channel: ReliableChannel, datagram: p2p_datagram.P2PDatagram,
+                       ack_addr: Optional[tuple], via: str):
+    # ack 예약 후 이미 (직접 또는 릴레이로) 받은 메시지면 버림
+    if not channel.accept(datagram.sender_id, datagram.seq, datagram.ack_requested, ack_addr):
+        return
+    kind = " 귓속말" if datagram.whisper else ""
+    print(f"[{node_id}] 📥 ({via}) P2P{kind} 메시지 수신 from [{datagram.sender_id}] "
+          f"@ {datagram.position}: {datagram.payload}")
+    try:
+        if datagram.type == p2p_datagram.TYPE_JSON:
+            content_data = datagram.payload
+            if isinstance(content_data, dict) and "alert_level" in content_data \
+                    and "latitude" in content_data and "longitude" in content_data:
+
+                # ⭐️ [2/4 TTS 추가] (직접 수신 / 서버 릴레이 수신 시)
+                tts.speak_async("전방 사람을 조심하세요", tts.PRIORITY_ALERT)
+
+                asyncio.create_task(
+                    send_alert_to_gps_service(
+                        content_data["latitude"], content_data["longitude"], content_data["alert_level"]
+                    )
+                )
+            # Unity로는 JSON 문자열로 전달
+            unity_socket.sendto(json.dumps(content_data).encode('utf-8'), (UNITY_HOST, UNITY_PORT))
+        elif datagram.type == p2p_datagram.TYPE_TEXT:
+            unity_socket.sendto(datagram.payload.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
+    except Exception as e:
+        print(f"Unity로 UDP 방송 또는 GPS 서비스 호출 실패: {e}")
+
+
+def forward_legacy_text(node_id: str, text: str, source: str, via: str):
+    """구버전 클라이언트의 "[..]: 본문" 메시지는 본문만 Unity 로 전달. 하트비트/펀칭 같은 제어 메시지는 버림."""
+    payload = p2p_datagram.legacy_text_payload(text)
+    if payload is None:
+        return
+    print(f"[{node_id}] 📥 ({via}) 구형식 메시지 수신 from {source}: {payload}")
+    try:
+        unity_socket.sendto(payload.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
+    except Exception as e:
+        print(f"Unity로 UDP 방송 실패: {e}")
 
 
 # --- P2P(UDP) 통신을 위한 프로토콜 클래스 ---
 class PeerProtocol:
-    def __init__(self, node_id: str):
+    def __init__(self, node_id: str, peers: PeerTable, channel: ReliableChannel):
         self.node_id = node_id
+        self.peers = peers
+        self.channel = channel
         self.transport = None
 
     def connection_made(self, transport: asyncio.DatagramTransport):
@@ -37,40 +349,27 @@ class PeerProtocol:
         print(f"[{self.node_id}] P2P UDP 소켓이 {transport.get_extra_info('sockname')} 에서 열렸습니다.")
 
     def datagram_received(self, data: bytes, addr: tuple):
-        decoded_data = data.decode()
-        if not decoded_data.startswith("p2p_heartbeat"):
-            print(f"[{self.node_id}] 📥 (UDP) P2P 메시지 수신 from {addr}: {decoded_data}")
-            try:
-                # Alert 메시지이면 GPS 서비스에 핀 생성 요청
-                match_json = re.search(r":\s*(\{.*\})", decoded_data)
-                if match_json:
-                    content_json_str = match_json.group(1)
-                    try:
-                        content_data = json.loads(content_json_str)
-                        if "alert_level" in content_data and "latitude" in content_data and "longitude" in content_data:
-
-                            # ⭐️ [2/4 TTS 추가] (직접 수신 시)
-                            tts.speak("전방 사람을 조심하세요")
-
-                            asyncio.create_task(
-                                send_alert_to_gps_service(
-                                    content_data["latitude"], content_data["longitude"], content_data["alert_level"]
-                                )
-                            )
-                            # Unity로는 JSON 문자열 그대로 전달
-                            unity_socket.sendto(content_json_str.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
-                        else:  # 일반 JSON
-                            unity_socket.sendto(content_json_str.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
-                    except json.JSONDecodeError:  # 단순 문자열
-                        match_content = re.search(r":\s*(.*)", decoded_data)
-                        content_only = match_content.group(1).strip() if match_content else decoded_data
-                        unity_socket.sendto(content_only.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
-                else:  # JSON 아닌 단순 문자열
-                    match_content = re.search(r":\s*(.*)", decoded_data)
-                    content_only = match_content.group(1).strip() if match_content else decoded_data
-                    unity_socket.sendto(content_only.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
-            except Exception as e:
-                print(f"Unity로 UDP 방송 또는 GPS 서비스 호출 실패: {e}")
+        datagram = p2p_datagram.decode(data)
+        if datagram is None:
+            if not p2p_datagram.is_other_version(data):
+                forward_legacy_text(self.node_id, data.decode('utf-8', errors='replace'), str(addr), "UDP")
+            return
+        if datagram.type == p2p_datagram.TYPE_HEARTBEAT_ACK:
+            self.peers.ack_received(datagram.sender_id, datagram.timestamp, time.monotonic())
+            return
+        # 데이터/ack/하트비트 모두 직접 경로가 살아 있다는 증거: 이 피어로의 다음 하트비트를 미룸
+        self.peers.seen(datagram.sender_id, time.monotonic(), datagram.position)
+        if datagram.type == p2p_datagram.TYPE_HEARTBEAT:
+            # 받은 시각을 그대로 돌려줘 상대가 RTT 를 재도록 함
+            if self.transport:
+                self.transport.sendto(p2p_datagram.heartbeat_ack(self.node_id, datagram.timestamp), addr)
+            return
+        if datagram.type == p2p_datagram.TYPE_ACK:
+            self.channel.on_ack(datagram.sender_id, datagram.payload)
+            return
+        if datagram.type == p2p_datagram.TYPE_PUNCH:
+            return
+        handle_p2p_message(self.node_id, self.channel, datagram, addr, "UDP")
 
     def error_received(self, exc: Exception):
         print(f"[{self.node_id}] P2P UDP 오류 발생: {exc}")
@@ -81,11 +380,14 @@ class PeerProtocol:
 
 # --- 외부 명령 수신용 프로토콜 클래스 ---
 class CommandProtocol:
-    def __init__(self, p2p_transport: asyncio.DatagramTransport, p2p_peers: Dict, my_node_id: str,
+    def __init__(self, p2p_transport: asyncio.DatagramTransport, p2p_peers: PeerTable, my_node_id: str,
                  websocket_queue: asyncio.Queue, gps_queue: asyncio.Queue, first_gps_event: asyncio.Event,
-                 client_state: Dict):
+                 client_state: Dict, group_members: set, channel: ReliableChannel):
         self.p2p_transport = p2p_transport
         self.p2p_peers = p2p_peers
+        self.group_members = group_members
+        self.channel = channel
+        self.transport = None
         self.my_node_id = my_node_id
         self.websocket_queue = websocket_queue
         self.gps_queue = gps_queue
@@ -93,11 +395,21 @@ class CommandProtocol:
         self.client_state = client_state
 
     def connection_made(self, transport):
+        self.transport = transport
         print(f"✅ [{self.my_node_id}] 외부 명령 수신 대기 중 on {transport.get_extra_info('sockname')}")
 
     def datagram_received(self, data, addr):
         try:
             message = json.loads(data.decode())
+            if message.get("stats"):
+                # {"stats": true} -> 직접 경로 상태와 경고 전달 통계를 JSON 으로 응답
+                now = time.monotonic()
+                report = {"reliability": self.channel.summary(), "loop_lag": loop_lag_stats,
+                          "tts": tts.speech_stats(), "heartbeat": self.p2p_peers.stats,
+                          "heartbeat_interval_s": round(self.p2p_peers.heartbeat_interval, 2),
+                          "peers": self.p2p_peers.summary(now)}
+                self.transport.sendto(json.dumps(report).encode(), addr)
+                return
             if "gps" in message:
                 gps_data = message["gps"]
                 if "latitude" in gps_data and "longitude" in gps_data:
@@ -112,37 +424,59 @@ class CommandProtocol:
 
             lat = self.client_state.get('latitude', 0.0)
             lon = self.client_state.get('longitude', 0.0)
-            location_str = f"@ ({lat:.5f}, {lon:.5f})"
 
             if isinstance(content, dict) and "alert_level" in content:
 
                 # ⭐️ [3/4 TTS 추가] (외부 명령으로 P2P 방송 시)
                 # (만약 외부 명령 자체가 경고라면, 여기서도 TTS를 재생할 수 있습니다.)
-                # tts.speak("전방 사람을 조심하세요")
+                # tts.speak_async("전방 사람을 조심하세요", tts.PRIORITY_ALERT)
                 # (참고: 이 부분은 '내가 보낼 때' 울리므로, 원치 않으면 주석 처리해 두세요.)
 
                 p2p_content = json.dumps(content)
             else:
                 p2p_content = str(content)
 
+            # 같은 메시지는 직접 전송/릴레이 모두 같은 데이터그램(같은 번호)을 써서 수신 측이 한 번만 처리
+            # 경고는 ack 를 받을 때까지 제한된 횟수만큼 UDP 재전송
+            reliable = isinstance(content, dict) and "alert_level" in content
+            seq = self.channel.next_seq()
+            msg_type = p2p_datagram.TYPE_JSON if isinstance(content, dict) else p2p_datagram.TYPE_TEXT
+            payload = content if isinstance(content, dict) else p2p_content
+            flags = p2p_datagram.FLAG_WHISPER if target_id else 0
+            full_message = self.channel.build(seq, msg_type, payload, (lat, lon), reliable, flags)
+            relay_content = p2p_datagram.to_relay_text(full_message)
+
             if not target_id:  # 그룹 전체 방송
                 print(f"📣 [{self.my_node_id}] 외부 명령 수신: 그룹 전체에 '{p2p_content}' 방송")
-                full_message = f"[{self.my_node_id} {location_str}]: {p2p_content}"
                 if self.p2p_transport and self.p2p_peers:
                     for peer_id, peer_addr in self.p2p_peers.items():
-                        self.p2p_transport.sendto(full_message.encode('utf-8'), peer_addr)
-                        relay_msg = {"type": "p2p_relay", "target_id": peer_id, "content": full_message}
-                        self.websocket_queue.put_nowait(relay_msg)
+                        self.channel.send(peer_id, peer_addr, seq, full_message, reliable)
+                else:
+                    print("   -> 경고: 방송을 보낼 P2P 피어가 없습니다. 서버 릴레이로만 전송합니다.")
+                # 하트비트 응답으로 직접 경로가 확인된 피어는 서버 릴레이 대상에서 제외
+                healthy = [peer_id for peer_id in self.p2p_peers if self.p2p_peers.is_healthy(peer_id)]
+                if isinstance(content, dict) and "latitude" in content and "longitude" in content:
+                    # 위치가 있는 경고는 내 그룹이 아니라 위험 지점 주변 차량 전체에게 서버가 방송
+                    self.websocket_queue.put_nowait({
+                        "type": "geo_broadcast", "alert_id": uuid.uuid4().hex,
+                        "latitude": content["latitude"], "longitude": content["longitude"],
+                        "content": relay_content, "exclude": healthy,
+                    })
+                elif self.group_members - set(healthy) or not self.group_members:
+                    # 릴레이 사본은 피어 수만큼이 아니라 한 번만 보내고 서버가 나머지 그룹 멤버에게 복제
+                    self.websocket_queue.put_nowait({"type": "group_relay", "content": relay_content,
+                                                     "exclude": healthy})
                 else:
-                    print("   -> 경고: 방송을 보낼 P2P 피어가 없습니다.")
+                    print(f"   -> 그룹 멤버 {len(healthy)}명 모두 직접 경로 정상: 서버 릴레이 생략")
             else:  # 특정 대상에게 귓속말
                 print(f"📣 [{self.my_node_id}] 외부 명령 수신: [{target_id}]에게 '{p2p_content}' 전송")
-                full_message = f"[{self.my_node_id} {location_str} 귓속말]: {p2p_content}"
                 if self.p2p_transport and target_id in self.p2p_peers:
                     target_addr = self.p2p_peers[target_id]
-                    self.p2p_transport.sendto(full_message.encode('utf-8'), target_addr)
-                    relay_msg = {"type": "p2p_relay", "target_id": target_id, "content": full_message}
-                    self.websocket_queue.put_nowait(relay_msg)
+                    self.channel.send(target_id, target_addr, seq, full_message, reliable)
+                    if not self.p2p_peers.is_healthy(target_id):
+                        # 직접 경로가 검증 전이거나 최근 실패했으면 서버 릴레이로도 보냄
+                        relay_msg = {"type": "p2p_relay", "target_id": target_id, "content": relay_content}
+                        self.websocket_queue.put_nowait(relay_msg)
                 else:
                     print(f"   -> 오류: 타겟 [{target_id}]를 모르거나 P2P가 준비되지 않음")
         except Exception as e:
@@ -153,31 +487,98 @@ class CommandProtocol:
 
 
 # --- HTTP 요청 함수 추가 ---
+class GpsServicePinClient:
+    """gps_service 로 가는 임시 핀 요청을 하나의 keep-alive 세션으로 보내고,
+    PIN_BATCH_WINDOW_S 안에 들어온 경고는 /add_temp_pins 한 번으로 묶어 보냅니다 (중복 핀 병합은 서버에서)."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.pending: List[Dict] = []
+        self.flush_handle = None
+        self.flush_tasks = set()  # 진행 중인 flush (참조를 들고 있어야 GC 되지 않고 종료 시 기다릴 수 있음)
+        self.batch_supported = True  # 구버전 gps_service 면 /add_temp_pin 으로 한 건씩
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=60))
+        return self.session
+
+    def add_pin(self, lat: float, lon: float, level: int):
+        self.pending.append({"latitude": lat, "longitude": lon, "level": level, "type": 99})
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(PIN_BATCH_WINDOW_S, self.start_flush)
+
+    def start_flush(self):
+        task = asyncio.create_task(self.flush())
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self):
+        self.flush_handle = None
+        pins, self.pending = self.pending, []
+        if not pins:
+            return
+        try:
+            session = self.get_session()
+            if self.batch_supported:
+                url = f"{self.base_url}/add_temp_pins"
+                async with session.post(url, json={"pins": pins}) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        print(f"✅ GPS 서비스({url})에 임시 핀 {len(pins)}개 요청 -> {result.get('sent')}개 생성")
+                        return
+                    if response.status != 404:
+                        print(f"⚠️ GPS 서비스({url})에 임시 핀 생성 요청 실패: {response.status}")
+                        return
+                    self.batch_supported = False
+            url = f"{self.base_url}/add_temp_pin"
+            for pin in pins:
+                async with session.post(url, json=pin) as response:
+                    if response.status == 200:
+                        print(f"✅ GPS 서비스({url})에 임시 핀 생성 요청 성공 (Level: {pin['level']})")
+                    else:
+                        print(f"⚠️ GPS 서비스({url})에 임시 핀 생성 요청 실패: {response.status}")
+        except aiohttp.ClientConnectorError as e:
+            print(f"❌ GPS 서비스({self.base_url}) 연결 실패: {e}")
+        except Exception as e:
+            print(f"❌ 임시 핀 생성 요청 중 오류 발생: {e}")
+
+    async def close(self):
+        """종료 시 진행 중인 전송을 기다리고 모아 둔 핀을 보낸 뒤 keep-alive 세션을 닫습니다."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        if self.flush_tasks:
+            await asyncio.gather(*self.flush_tasks)
+        await self.flush()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+gps_pin_client = GpsServicePinClient(GPS_SERVICE_URL)
+
+
 async def send_alert_to_gps_service(lat: float, lon: float, level: int):
-    url = f"{GPS_SERVICE_URL}/add_temp_pin"
-    payload = {"latitude": lat, "longitude": lon, "type": 99}  #
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                if response.status == 200:
-                    print(f"✅ GPS 서비스({url})에 임시 핀 생성 요청 성공 (Level: {level})")
-                else:
-                    print(f"⚠️ GPS 서비스({url})에 임시 핀 생성 요청 실패: {response.status}")
-    except aiohttp.ClientConnectorError as e:
-        print(f"❌ GPS 서비스({url}) 연결 실패: {e}")
-    except Exception as e:
-        print(f"❌ 임시 핀 생성 요청 중 오류 발생: {e}")
+    gps_pin_client.add_pin(lat, lon, level)
 
 
 # --- 메인 클라이언트 로직 ---
-async def run_client(node_id: str, p2p_port_req: int, cmd_port_req: int):
+async def run_client(node_id: str, p2p_port_req: int, cmd_port_req: int, encoding: str = WS_ENCODING):
     base_server_uri = os.getenv("SERVER_URI")
     if not base_server_uri:
         print("🚨 오류: .env 파일에 SERVER_URI가 설정되지 않았습니다.")
         return
     server_uri = f"{base_server_uri}{node_id}"
-
-    my_p2p_peers: Dict[str, Tuple[str, int]] = {}
+    # 이쪽에 msgpack 이 없으면 서버가 바이너리로 보내도 디코딩할 수 없으므로 요청 전에 json 으로 낮춤
+    encoding = message_codec.negotiate(encoding)
+    if encoding != message_codec.ENCODING_JSON:
+        server_uri += f"?encoding={encoding}"
+
+    peers = PeerTable()
+    channel = ReliableChannel(node_id, peers.rtt_ms)
+    uplink = LocationUplink()
+    punch_message = p2p_datagram.encode(p2p_datagram.P2PDatagram(p2p_datagram.TYPE_PUNCH, node_id))
+    group_members = set()  # 서버가 알려준 내 그룹 멤버 (본인 제외)
     p2p_transport: asyncio.DatagramTransport = None
     websocket_queue = asyncio.Queue()
     gps_queue = asyncio.Queue()
@@ -186,12 +587,14 @@ async def run_client(node_id: str, p2p_port_req: int, cmd_port_req: int):
     loop = asyncio.get_running_loop()
 
     try:
-        p2p_transport, _ = await loop.create_datagram_endpoint(lambda: PeerProtocol(node_id),
+        p2p_transport, _ = await loop.create_datagram_endpoint(lambda: PeerProtocol(node_id, peers, channel),
                                                                local_addr=('0.0.0.0', p2p_port_req))
+        channel.transport = p2p_transport
         actual_p2p_port = p2p_transport.get_extra_info('sockname')[1]
         cmd_transport, _ = await loop.create_datagram_endpoint(
-            lambda: CommandProtocol(p2p_transport, my_p2p_peers, node_id, websocket_queue, gps_queue, first_gps_event,
-                                    client_state), local_addr=('127.0.0.1', cmd_port_req)
+            lambda: CommandProtocol(p2p_transport, peers, node_id, websocket_queue, gps_queue, first_gps_event,
+                                    client_state, group_members, channel),
+            local_addr=('127.0.0.1', cmd_port_req)
         )
         actual_cmd_port = cmd_transport.get_extra_info('sockname')[1]
         print(f"✅ 포트 자동 할당 -> P2P: {actual_p2p_port}, Command: {actual_cmd_port}")
@@ -226,120 +629,205 @@ async def run_client(node_id: str, p2p_port_req: int, cmd_port_req: int):
         print(f"UDP 포트를 열 수 없습니다: {e}")
         return
 
+    asyncio.create_task(monitor_loop_lag())
     print(f"\n[{node_id}] 클라이언트 시작. 첫 GPS 데이터를 기다립니다...")
     await first_gps_event.wait()
     print(f"🛰️ [{node_id}] 첫 GPS 데이터 수신 완료! 메인 서버에 연결을 시작합니다.")
 
+    resume_state = {"token": None}  # 서버 hello 로 받은 세션 재개 토큰
+    reconnect_delay = RECONNECT_DELAY_MIN_S
+    retry_hint = {"delay": None}  # 서버가 retry_later 로 알려준 재시도 시간
     while True:
+        connect_uri = server_uri
+        if resume_state["token"]:
+            connect_uri += ("&" if "?" in connect_uri else "?") + f"resume={resume_state['token']}"
         try:
-            async with websockets.connect(server_uri) as websocket:
+            async with websockets.connect(connect_uri) as websocket:
+                reconnect_delay = RECONNECT_DELAY_MIN_S
                 print(f"🚗 클라이언트 [{node_id}] 서버에 연결 성공!")
+                # 서버의 hello 응답으로 협상이 확정되기 전까지는 json 으로 송신
+                ws_state = {"encoding": message_codec.ENCODING_JSON}
+
+                async def send_ws(message: Dict):
+                    await websocket.send(message_codec.encode(message, ws_state["encoding"]))
 
                 async def send_p2p_heartbeat():
+                    now = time.monotonic()
+                    next_report = now + RELIABILITY_REPORT_S
+                    next_check = now + P2P_HEARTBEAT_INTERVAL_S
                     while True:
-                        await asyncio.sleep(5)
-                        if p2p_transport and my_p2p_peers:
-                            message = b'p2p_heartbeat'
-                            for peer_addr in my_p2p_peers.values():
-                                p2p_transport.sendto(message, peer_addr)
+                        # 피어별로 차례가 된 하트비트만 보냄 (한 주기에 전체 피어를 한꺼번에 보내지 않음)
+                        await asyncio.sleep(HEARTBEAT_TICK_S)
+                        now = time.monotonic()
+                        for peer_id in peers.due_heartbeats(now):
+                            send_heartbeat(peer_id)
+                        if now < next_check:
+                            continue
+                        next_check = now + P2P_HEARTBEAT_INTERVAL_S
+                        for peer_id in {key[0] for key in channel.pending} - set(peers):
+                            channel.forget_peer(peer_id)
+                        if now >= next_report:
+                            next_report += RELIABILITY_REPORT_S
+                            if channel.stats["reliable_sent"] or channel.stats["duplicates"]:
+                                print(f"[{node_id}] 📊 경고 전달 통계: {channel.summary()}")
+                            print(f"[{node_id}] 📊 이벤트 루프 지연: {loop_lag_stats} / TTS: {tts.speech_stats()}")
+                            print(f"[{node_id}] 📊 GPS 업링크: {uplink.stats}")
+                            print(f"[{node_id}] 📊 하트비트: 피어 {len(peers)}명, "
+                                  f"주기 {peers.heartbeat_interval:.1f}초, {peers.stats}")
+                        for peer_id in peers.check_timeouts(now):
+                            print(f"[{node_id}] ⚠️ [{peer_id}] 직접 경로 응답 없음: 서버 릴레이 병행")
 
                 async def websocket_sender():
                     while True:
                         message = await websocket_queue.get()
-                        await websocket.send(json.dumps(message))
+                        await send_ws(message)
+
+                def send_heartbeat(peer_id: str):
+                    if p2p_transport and peer_id in peers:
+                        now = time.monotonic()
+                        peers.heartbeat_sent(peer_id, now)
+                        p2p_transport.sendto(p2p_datagram.heartbeat(node_id, now), peers[peer_id])
+
+                async def request_p2p(peer_id: str):
+                    req_msg = {"type": "p2p_request", "target_id": peer_id, "sender_id": node_id,
+                               "port": actual_p2p_port}
+                    await send_ws(req_msg)
 
                 async def handle_server_messages():
                     async for message in websocket:
-                        data = json.loads(message)
+                        data = message_codec.decode(message)
                         msg_type = data.get("type")
-                        if msg_type == "p2p_message":
+                        if msg_type == "retry_later":
+                            # 서버 재시작 직후 접속 폭주 시: 서버가 정해준 (지터 포함) 시간 뒤에 다시 접속
+                            retry_hint["delay"] = float(data.get("retry_after_s", reconnect_delay))
+                        elif msg_type == "hello":
+                            ws_state["encoding"] = data.get("encoding", message_codec.ENCODING_JSON)
+                            print(f"[{node_id}] 🔧 서버와 인코딩 협상 완료: {ws_state['encoding']}")
+                            resume_state["token"] = data.get("resume_token")
+                            if data.get("resumed") or data.get("warm"):
+                                # 세션이 이어졌거나 서버가 웜 재시작으로 그룹을 복원했으면
+                                # 기존 피어 테이블과 홀 펀칭 결과를 그대로 사용 (p2p_request 재전송 폭주 방지)
+                                print(f"[{node_id}] 🔁 세션 재개 성공. 기존 피어 {len(peers)}명 유지")
+                            elif peers:
+                                peers.clear()
+                                group_members.clear()
+                        elif msg_type == "p2p_message":
                             content = data.get("content", "")
-                            print(f"[{node_id}] 📥 (RELAY) P2P 메시지 수신 from [{data['from_id']}]: {content}")
-                            try:
-                                # 릴레이 메시지 처리 및 HTTP 호출 / Unity 방송
-                                match_json = re.search(r":\s*(\{.*\})", content)
-                                if match_json:
-                                    content_json_str = match_json.group(1)
-                                    try:
-                                        content_data = json.loads(content_json_str)
-                                        if "alert_level" in content_data and "latitude" in content_data and "longitude" in content_data:
-
-                                            # ⭐️ [4/4 TTS 추가] (서버 릴레이 수신 시)
-                                            tts.speak("전방 사람을 조심하세요")
-
-                                            asyncio.create_task(
-                                                send_alert_to_gps_service(
-                                                    content_data["latitude"], content_data["longitude"],
-                                                    content_data["alert_level"],
-                                                )
-                                            )
-                                            unity_socket.sendto(content_json_str.encode('utf-8'),
-                                                                (UNITY_HOST, UNITY_PORT))
-                                        else:
-                                            unity_socket.sendto(content_json_str.encode('utf-8'),
-                                                                (UNITY_HOST, UNITY_PORT))
-                                    except json.JSONDecodeError:
-                                        unity_socket.sendto(content.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
-                                else:
-                                    match_content = re.search(r":\s*(.*)", content)
-                                    content_only = match_content.group(1).strip() if match_content else content
-                                    unity_socket.sendto(content_only.encode('utf-8'), (UNITY_HOST, UNITY_PORT))
-                            except Exception as e:
-                                print(f"Unity로 UDP 방송 또는 GPS 서비스 호출 실패: {e}")
+                            datagram = p2p_datagram.from_relay_text(content)
+                            if datagram is not None:
+                                # 직접 경로로 이미 받은 메시지면 버리고, 경고면 UDP 로 ack 해 재전송을 멈춤
+                                # (릴레이 수신은 직접 경로의 증거가 아니므로 위치만 갱신)
+                                peers.set_position(datagram.sender_id, datagram.position)
+                                handle_p2p_message(node_id, channel, datagram, peers.get(datagram.sender_id),
+                                                   "RELAY")
+                                continue
+                            if isinstance(content, str) and not content.startswith(p2p_datagram.RELAY_TEXT_PREFIX):
+                                forward_legacy_text(node_id, content, f"[{data['from_id']}]", "RELAY")
 
                         elif msg_type == "group_update":
+                            # 서버가 주기적으로 보내는 내 그룹 전체 스냅샷 (좌표 갱신 겸 멤버십 보정)
                             members = data.get("data", [])
                             print(f"[{node_id}] 📢 그룹 업데이트! 멤버: {[m['node_id'] for m in members]}")
                             current_peer_ids = {m['node_id'] for m in members}
-                            for peer_id in list(my_p2p_peers.keys()):
-                                if peer_id not in current_peer_ids:
-                                    del my_p2p_peers[peer_id]
-                                    print(f"[{node_id}] ❌ {peer_id}와 P2P 연결 목록에서 제거.")
+                            group_members.clear()
+                            group_members.update(current_peer_ids - {node_id})
+                            for peer_id in peers.retain(current_peer_ids):
+                                print(f"[{node_id}] ❌ {peer_id}와 P2P 연결 목록에서 제거.")
                             for member in members:
                                 peer_id = member["node_id"]
-                                if peer_id != node_id and peer_id not in my_p2p_peers:
-                                    req_msg = {"type": "p2p_request", "target_id": peer_id, "sender_id": node_id,
-                                               "port": actual_p2p_port}
-                                    await websocket.send(json.dumps(req_msg))
+                                peers.set_position(peer_id, member.get("location"))
+                                if peer_id != node_id and peer_id not in peers:
+                                    await request_p2p(peer_id)
+                        elif msg_type == "group_delta":
+                            # 멤버십이 바뀐 경우에만 오는 join/leave 델타
+                            for peer_id in data.get("left", []):
+                                group_members.discard(peer_id)
+                                if peers.remove(peer_id):
+                                    print(f"[{node_id}] ❌ {peer_id}와 P2P 연결 목록에서 제거.")
+                            for member in data.get("joined", []):
+                                peer_id = member["node_id"]
+                                print(f"[{node_id}] ➕ 그룹 합류: {peer_id}")
+                                peers.set_position(peer_id, member.get("location"))
+                                if peer_id != node_id:
+                                    group_members.add(peer_id)
+                                # 양쪽 모두 델타를 받으므로 ID가 작은 쪽만 홀 펀칭을 시작
+                                if peer_id != node_id and peer_id not in peers and node_id < peer_id:
+                                    await request_p2p(peer_id)
                         elif msg_type == "p2p_request":
                             sender_id, sender_ip, sender_port = data["sender_id"], data["ip"], data["port"]
                             print(f"[{node_id}] 🤝 [{sender_id}]로부터 P2P 연결 요청 수신.")
-                            my_p2p_peers[sender_id] = (sender_ip, sender_port)
+                            peers.add(sender_id, (sender_ip, sender_port))
                             res_msg = {"type": "p2p_response", "target_id": sender_id, "sender_id": node_id,
                                        "port": actual_p2p_port}
-                            await websocket.send(json.dumps(res_msg))
-                            if p2p_transport: p2p_transport.sendto(f"Punch from {node_id}".encode(),
+                            await send_ws(res_msg)
+                            if p2p_transport: p2p_transport.sendto(punch_message,
                                                                    (sender_ip, sender_port))
+                            send_heartbeat(sender_id)  # 다음 주기를 기다리지 않고 바로 경로 검증 시작
                         elif msg_type == "p2p_response":
                             sender_id, sender_ip, sender_port = data["sender_id"], data["ip"], data["port"]
                             print(f"[{node_id}] 🤝 [{sender_id}]로부터 P2P 연결 응답 수신.")
-                            my_p2p_peers[sender_id] = (sender_ip, sender_port)
-                            if p2p_transport: p2p_transport.sendto(f"Punch from {node_id}".encode(),
+                            peers.add(sender_id, (sender_ip, sender_port))
+                            if p2p_transport: p2p_transport.sendto(punch_message,
                                                                    (sender_ip, sender_port))
+                            send_heartbeat(sender_id)
 
                 async def send_location():
+                    uplink.reset()
                     current_location = await gps_queue.get()
                     while True:
+                        # 전송이 밀리는 동안 쌓인 오래된 좌표는 버리고 가장 최신 좌표만 사용
+                        while not gps_queue.empty():
+                            current_location = gps_queue.get_nowait()
+                            uplink.stats["dropped_stale"] += 1
+                        uplink.observe(current_location)
                         # 최신 위치를 client_state에 업데이트
                         client_state['latitude'] = current_location.get('latitude', 0.0)
                         client_state['longitude'] = current_location.get('longitude', 0.0)
 
-                        await websocket.send(json.dumps(current_location))
+                        now = time.monotonic()
+                        reason = uplink.reason_to_send(current_location, now)
+                        if reason:
+                            await send_ws(current_location)
+                            uplink.sent(current_location, now, reason)
+                        else:
+                            uplink.stats["suppressed"] += 1
                         try:
-                            new_gps = await asyncio.wait_for(gps_queue.get(), timeout=1.0)
-                            current_location = new_gps
+                            # 새 좌표가 오면 바로 처리하고, 없으면 keep-alive 시점에 같은 좌표를 다시 보냄
+                            current_location = await asyncio.wait_for(gps_queue.get(),
+                                                                      timeout=uplink.wait_timeout(time.monotonic()))
                             # print(f"🛰️ 외부 GPS 데이터 수신: {current_location}") # 로그 너무 많으면 주석 처리
                         except asyncio.TimeoutError:
-                            await asyncio.sleep(1)
+                            pass
 
-                await asyncio.gather(
-                    handle_server_messages(), send_location(),
-                    send_p2p_heartbeat(), websocket_sender()
-                )
+                # 연결이 끊기면 나머지 루프도 함께 취소해 다음 연결과 겹치지 않게 함
+                # (남은 websocket_sender 가 다음 릴레이 메시지를 닫힌 소켓으로 보내 잃어버리는 것 방지)
+                tasks = [asyncio.create_task(coro) for coro in (
+                    handle_server_messages(), send_location(), send_p2p_heartbeat(), websocket_sender())]
+                try:
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()  # 예외가 있으면 그대로 올려 재접속 처리
+                    raise ConnectionError("서버가 연결을 닫았습니다")
+                finally:
+                    for task in tasks:
+                        task.cancel()
         except Exception as e:
-            print(f"클라이언트 [{node_id}] 연결 오류: {e}. 5초 후 재시도...")
-            my_p2p_peers.clear()
-            await asyncio.sleep(5)
+            # 피어 테이블은 세션 재개 여부(hello.resumed)가 확인될 때까지 유지
+            if retry_hint["delay"] is not None:
+                delay, retry_hint["delay"] = retry_hint["delay"], None
+            else:
+                # 서버 재시작 시 모든 차량이 같은 순간에 재접속하지 않도록 지터를 섞음
+                delay = reconnect_delay * random.uniform(0.5, 1.5)
+                reconnect_delay = min(reconnect_delay * 2, RECONNECT_DELAY_MAX_S)
+            print(f"클라이언트 [{node_id}] 연결 오류: {e}. {delay:.1f}초 후 재시도...")
+            await asyncio.sleep(delay)
+
+
+async def main(node_id: str, p2p_port_req: int, cmd_port_req: int, encoding: str = WS_ENCODING):
+    try:
+        await run_client(node_id, p2p_port_req, cmd_port_req, encoding)
+    finally:
+        await gps_pin_client.close()
 
 
 if __name__ == "__main__":
@@ -347,6 +835,8 @@ if __name__ == "__main__":
     parser.add_argument("--id", help="[Optional] Client's unique node ID")
     parser.add_argument("--port", type=int, default=0)
     parser.add_argument("--cmd-port", type=int, default=0)
+    parser.add_argument("--encoding", choices=message_codec.supported_encodings(),
+                        default=WS_ENCODING, help="메인 서버와의 메시지 인코딩")
     args = parser.parse_args()
     if not args.id:
         adjectives = ["Brave", "Clever", "Fast", "Silent", "Wise", "Happy"]
@@ -357,6 +847,6 @@ if __name__ == "__main__":
         node_id = args.id
     try:
         # GPS 대기 로직 포함, lat/lon 없이 호출
-        asyncio.run(run_client(node_id, args.port, args.cmd_port))
+        asyncio.run(main(node_id, args.port, args.cmd_port, args.encoding))
     except KeyboardInterrupt:
         print(f"\n클라이언트 [{node_id}]을 종료합니다.")
\ No newline at end of file
@@ -0,0 +1,141 @@
+# p2p_datagram.py (p2p_client.py P2P 데이터그램 인코더/디코더)
+# 직접 UDP 전송과 서버 릴레이(content 문자열)가 같은 형식을 씁니다.
+#
+# 헤더 (struct "<BBBBIdiiB", 25바이트)
+#   magic(0xD7) | version | type | flags | seq(u32) | timestamp(f64) | lat*1e7(i32) | lon*1e7(i32) | sender 길이
+# 이어서 sender(utf-8), 본문. 본문은 type 에 따라:
+#   TEXT: utf-8 문자열 / JSON: JSON 객체 / ACK: u32 번호 목록 / HEARTBEAT, HEARTBEAT_ACK, PUNCH: 없음
+# HEARTBEAT_ACK 의 timestamp 는 받은 HEARTBEAT 의 timestamp 를 그대로 돌려준 값 (RTT 측정용)
+import base64
+import json
+import struct
+from typing import Any, List, NamedTuple, Optional, Tuple, Union
+
+MAGIC = 0xD7  # 기존 텍스트 메시지(ASCII/UTF-8 '[' 'P' 'p' 등)와 첫 바이트로 구분
+VERSION = 1
+HEADER = struct.Struct("<BBBBIdiiB")
+COORD_SCALE = 1e7
+
+TYPE_TEXT = 1
+TYPE_JSON = 2
+TYPE_ACK = 3
+TYPE_HEARTBEAT = 4
+TYPE_HEARTBEAT_ACK = 5
+TYPE_PUNCH = 6
+
+FLAG_ACK_REQUESTED = 0x01
+FLAG_WHISPER = 0x02
+
+RELAY_TEXT_PREFIX = "p2p1:"  # 서버 릴레이 content 는 문자열이므로 base64 로 감쌈
+
+
+class P2PDatagram(NamedTuple):
+    type: int
+    sender_id: str
+    seq: int = 0
+    timestamp: float = 0.0
+    position: Optional[Tuple[float, float]] = None
+    flags: int = 0
+    payload: Any = None
+
+    @property
+    def ack_requested(self) -> bool:
+        return bool(self.flags & FLAG_ACK_REQUESTED)
+
+    @property
+    def whisper(self) -> bool:
+        return bool(self.flags & FLAG_WHISPER)
+
+
+def _encode_payload(msg_type: int, payload: Any) -> bytes:
+    if msg_type == TYPE_TEXT:
+        return str(payload).encode("utf-8")
+    if msg_type == TYPE_JSON:
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    if msg_type == TYPE_ACK:
+        return struct.pack(f"<{len(payload)}I", *payload)
+    return b""
+
+
+def _decode_payload(msg_type: int, body: bytes) -> Any:
+    if msg_type == TYPE_TEXT:
+        return body.decode("utf-8")
+    if msg_type == TYPE_JSON:
+        return json.loads(body)
+    if msg_type == TYPE_ACK:
+        return list(struct.unpack(f"<{len(body) // 4}I", body[:len(body) // 4 * 4]))
+    return None
+
+
+def encode(datagram: P2PDatagram) -> bytes:
+    sender = datagram.sender_id.encode("utf-8")[:255]
+    lat, lon = datagram.position if datagram.position is not None else (0.0, 0.0)
+    header = HEADER.pack(MAGIC, VERSION, datagram.type, datagram.flags, datagram.seq & 0xFFFFFFFF,
+                         datagram.timestamp, int(round(lat * COORD_SCALE)), int(round(lon * COORD_SCALE)),
+                         len(sender))
+    return header + sender + _encode_payload(datagram.type, datagram.payload)
+
+
+def decode(data: Union[bytes, bytearray]) -> Optional[P2PDatagram]:
+    """이 형식이 아니거나(구버전 텍스트) 손상된 데이터면 None."""
+    if len(data) < HEADER.size or data[0] != MAGIC or data[1] != VERSION:
+        return None
+    try:
+        _, _, msg_type, flags, seq, timestamp, lat, lon, sender_len = HEADER.unpack_from(data)
+        sender_end = HEADER.size + sender_len
+        sender_id = bytes(data[HEADER.size:sender_end]).decode("utf-8")
+        payload = _decode_payload(msg_type, bytes(data[sender_end:]))
+    except (struct.error, UnicodeDecodeError, ValueError):
+        return None
+    position = (lat / COORD_SCALE, lon / COORD_SCALE) if (lat or lon) else None
+    return P2PDatagram(msg_type, sender_id, seq, timestamp, position, flags, payload)
+
+
+def to_relay_text(data: bytes) -> str:
+    return RELAY_TEXT_PREFIX + base64.b64encode(data).decode("ascii")
+
+
+def from_relay_text(content: Any) -> Optional[P2PDatagram]:
+    if not isinstance(content, str) or not content.startswith(RELAY_TEXT_PREFIX):
+        return None
+    try:
+        return decode(base64.b64decode(content[len(RELAY_TEXT_PREFIX):]))
+    except ValueError:
+        return None
+
+
+# --- 구버전 클라이언트 텍스트 메시지 ---
+LEGACY_CONTROL_PREFIXES = ("p2p_heartbeat", "Punch from", "p2p_ack")  # 사용자에게 보여줄 내용이 없는 제어 메시지
+LEGACY_FRAME_PREFIX = "p2p_msg:"  # p2p_msg:<보낸 노드>:<번호>:<a|->:<본문>
+
+
+def legacy_text_payload(text: str) -> Optional[str]:
+    """구형식 "[보낸 노드 @ (lat, lon)]: 본문" 에서 본문만 꺼냅니다. 제어 메시지나 모르는 형식이면 None."""
+    if text.startswith(LEGACY_CONTROL_PREFIXES):
+        return None
+    if text.startswith(LEGACY_FRAME_PREFIX):
+        parts = text.split(":", 4)
+        if len(parts) != 5:
+            return None
+        text = parts[4]
+    if not text.startswith("["):
+        return None
+    _, separator, payload = text.partition("]:")
+    return payload.strip() if separator else None
+
+
+def is_other_version(data: Union[bytes, bytearray]) -> bool:
+    """이 형식(MAGIC)이지만 다른 VERSION 인 데이터그램. 해석할 수 없으므로 버림."""
+    return len(data) >= 2 and data[0] == MAGIC and data[1] != VERSION
+
+
+def ack(sender_id: str, seqs: List[int]) -> bytes:
+    return encode(P2PDatagram(TYPE_ACK, sender_id, payload=seqs))
+
+
+def heartbeat(sender_id: str, timestamp: float) -> bytes:
+    return encode(P2PDatagram(TYPE_HEARTBEAT, sender_id, timestamp=timestamp))
+
+
+def heartbeat_ack(sender_id: str, echoed_timestamp: float) -> bytes:
+    return encode(P2PDatagram(TYPE_HEARTBEAT_ACK, sender_id, timestamp=echoed_timestamp))
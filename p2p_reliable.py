@@ -0,0 +1,148 @@
+# p2p_reliable.py (p2p_client.py 용 P2P UDP 메시지 번호 / 재전송 / 중복 제거)
+# - 모든 P2P 메시지에 (보낸 노드, 메시지 번호)를 붙여 직접 수신과 서버 릴레이 수신이 겹쳐도 한 번만 처리
+# - 경고(alert) 메시지는 수신 측이 번호 목록으로 골라서 ack(선택적 ack)하고, ack 가 없으면 제한된 횟수만 재전송
+# 데이터그램 형식은 p2p_datagram.py (FLAG_ACK_REQUESTED, TYPE_ACK)
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import p2p_datagram
+from relay_metrics import percentile
+
+RETRANSMIT_MAX = 4  # 첫 전송 이후 최대 재전송 횟수
+RTO_MIN_S = 0.2
+RTO_MAX_S = 2.0
+ACK_DELAY_S = 0.02  # 같은 피어로 가는 ack 를 잠깐 모아서 한 패킷으로
+DEDUP_WINDOW_S = 120.0
+DEDUP_MAX_ENTRIES = 4096
+
+
+class DedupWindow:
+    """최근 받은 (보낸 노드, 번호)를 기억해 같은 메시지를 두 번 처리하지 않게 합니다."""
+
+    def __init__(self, window_s: float = DEDUP_WINDOW_S, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.window_s = window_s
+        self.max_entries = max_entries
+        self.seen: "OrderedDict[Tuple[str, int], float]" = OrderedDict()
+
+    def is_duplicate(self, sender_id: str, seq: int, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        while self.seen and (len(self.seen) >= self.max_entries or
+                             now - next(iter(self.seen.values())) > self.window_s):
+            self.seen.popitem(last=False)
+        key = (sender_id, seq)
+        if key in self.seen:
+            return True
+        self.seen[key] = now
+        return False
+
+
+class ReliableChannel:
+    """P2P UDP 소켓 위의 번호 매김 / 선택적 ack / 제한 재전송."""
+
+    def __init__(self, node_id: str, rtt_ms_for: Callable[[str], Optional[float]] = lambda peer_id: None):
+        self.node_id = node_id
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.rtt_ms_for = rtt_ms_for
+        self.seq = random.getrandbits(31)  # 재시작 후 번호가 이전 것과 겹치지 않도록 임의 시작
+        self.pending: Dict[Tuple[str, int], Dict] = {}
+        self.ack_batches: Dict[str, Tuple[tuple, List[int]]] = {}
+        self.dedup = DedupWindow()
+        self.latency_ms: deque = deque(maxlen=1000)
+        self.stats = {"sent": 0, "reliable_sent": 0, "acked": 0, "retransmits": 0, "gave_up": 0,
+                      "received": 0, "duplicates": 0}
+        self.task: Optional[asyncio.Task] = None
+
+    # --- 송신 ---
+    def next_seq(self) -> int:
+        self.seq = (self.seq + 1) & 0x7FFFFFFF
+        return self.seq
+
+    def build(self, seq: int, msg_type: int, payload: Any, position: Optional[Tuple[float, float]],
+              reliable: bool, flags: int = 0) -> bytes:
+        if reliable:
+            flags |= p2p_datagram.FLAG_ACK_REQUESTED
+        return p2p_datagram.encode(p2p_datagram.P2PDatagram(
+            msg_type, self.node_id, seq, time.time(), position, flags, payload))
+
+    def send(self, peer_id: str, addr: tuple, seq: int, data: bytes, reliable: bool):
+        if self.transport is None:
+            return
+        self.transport.sendto(data, addr)
+        self.stats["sent"] += 1
+        if reliable:
+            now = time.monotonic()
+            self.stats["reliable_sent"] += 1
+            self.pending[(peer_id, seq)] = {"data": data, "addr": addr, "first_sent": now, "attempts": 0,
+                                            "next_at": now + self.rto(peer_id, 0)}
+            if self.task is None or self.task.done():
+                self.task = asyncio.create_task(self._retransmit_loop())
+
+    def rto(self, peer_id: str, attempts: int) -> float:
+        rtt_ms = self.rtt_ms_for(peer_id)
+        base = max(RTO_MIN_S, 2 * rtt_ms / 1000) if rtt_ms else RTO_MIN_S * 2
+        return min(RTO_MAX_S, base * (2 ** attempts))
+
+    async def _retransmit_loop(self):
+        while self.pending:
+            await asyncio.sleep(RTO_MIN_S / 4)
+            now = time.monotonic()
+            for key, entry in list(self.pending.items()):
+                if now < entry["next_at"]:
+                    continue
+                if entry["attempts"] >= RETRANSMIT_MAX:
+                    del self.pending[key]
+                    self.stats["gave_up"] += 1
+                    continue
+                entry["attempts"] += 1
+                entry["next_at"] = now + self.rto(key[0], entry["attempts"])
+                self.stats["retransmits"] += 1
+                if self.transport is not None:
+                    self.transport.sendto(entry["data"], entry["addr"])
+
+    def on_ack(self, peer_id: str, seqs: List[int]):
+        now = time.monotonic()
+        for seq in seqs:
+            entry = self.pending.pop((peer_id, seq), None)
+            if entry is not None:
+                self.stats["acked"] += 1
+                self.latency_ms.append((now - entry["first_sent"]) * 1000)
+
+    def forget_peer(self, peer_id: str):
+        for key in [k for k in self.pending if k[0] == peer_id]:
+            del self.pending[key]
+
+    # --- 수신 ---
+    def accept(self, sender_id: str, seq: int, reliable: bool, ack_addr: Optional[tuple]) -> bool:
+        """처음 받은 메시지면 True. ack 요청이 있으면 (중복이어도) ack 를 예약합니다."""
+        if reliable and ack_addr is not None:
+            self.queue_ack(sender_id, ack_addr, seq)
+        if self.dedup.is_duplicate(sender_id, seq):
+            self.stats["duplicates"] += 1
+            return False
+        self.stats["received"] += 1
+        return True
+
+    def queue_ack(self, peer_id: str, addr: tuple, seq: int):
+        batch = self.ack_batches.get(peer_id)
+        if batch is None:
+            self.ack_batches[peer_id] = (addr, [seq])
+            asyncio.get_running_loop().call_later(ACK_DELAY_S, self._flush_acks, peer_id)
+        else:
+            batch[1].append(seq)
+
+    def _flush_acks(self, peer_id: str):
+        addr, seqs = self.ack_batches.pop(peer_id, (None, []))
+        if seqs and self.transport is not None:
+            self.transport.sendto(p2p_datagram.ack(self.node_id, seqs), addr)
+
+    # --- 통계 ---
+    def summary(self) -> Dict:
+        ordered = sorted(self.latency_ms)
+        reliable_sent = self.stats["reliable_sent"]
+        return {**self.stats, "pending": len(self.pending),
+                "retransmit_rate": round(self.stats["retransmits"] / reliable_sent, 3) if reliable_sent else 0.0,
+                "delivery_p50_ms": round(percentile(ordered, 0.5), 2),
+                "delivery_p99_ms": round(percentile(ordered, 0.99), 2)}
@@ -0,0 +1,209 @@
+# replay_capture.py (main.py 트래픽 캡처 재생기)
+# CAPTURE_PATH 로 기록한 실제 트래픽(출퇴근 시간대 등)을 로컬 main.py 에 같은 시간 간격으로 다시 보내고,
+# 재생 중 서버가 보낸 메시지를 캡처 당시의 출력과 비교합니다.
+#   - 메시지 종류별 송신 건수 (캡처 vs 재생)
+#   - 차량별 최종 그룹 멤버 일치율 (group_update/group_delta 기준)
+#
+# 예) CAPTURE_PATH=rush.cap python main.py                 # 운영/스테이징에서 캡처
+#     python replay_capture.py rush.cap --speed 1           # 실제 속도
+#     python replay_capture.py rush.cap --speed 5           # 5배속
+#     python replay_capture.py rush*.cap --speed 0 --spawn-server --backend memory   # 최대 속도
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Set
+from urllib.parse import parse_qsl, urlencode
+
+import websockets
+
+import message_codec
+from load_test import spawn_server
+from traffic_capture import KIND_CLOSE, KIND_IN, KIND_NAMES, KIND_OPEN, KIND_OUT, CaptureRecord, read_capture
+
+
+def load_records(paths: List[str]) -> List[CaptureRecord]:
+    records = []
+    for path in paths:
+        records.extend(read_capture(path))
+    records.sort(key=lambda r: r.ts)  # 워커별 파일을 시각순으로 합침
+    return records
+
+
+def message_type(data) -> str:
+    try:
+        message = message_codec.decode(data)
+    except Exception:
+        return "undecodable"
+    return message.get("type") or ("gps" if "latitude" in message else "unknown")
+
+
+class GroupTracker:
+    """서버 출력에서 차량별 현재 그룹 멤버를 추적합니다."""
+
+    def __init__(self):
+        self.groups: Dict[str, Set[str]] = {}
+
+    def apply(self, node_id: str, data):
+        try:
+            message = message_codec.decode(data)
+        except Exception:
+            return
+        msg_type = message.get("type")
+        if msg_type == "group_update":
+            self.groups[node_id] = {m["node_id"] for m in message.get("data", []) if m["node_id"] != node_id}
+        elif msg_type == "group_delta":
+            members = self.groups.setdefault(node_id, set())
+            members.update(m["node_id"] for m in message.get("joined", []))
+            members.difference_update(message.get("left", []))
+
+
+class OutputSummary:
+    def __init__(self):
+        self.by_type: Dict[str, int] = {}
+        self.groups = GroupTracker()
+
+    def add(self, node_id: str, data):
+        msg_type = message_type(data)
+        self.by_type[msg_type] = self.by_type.get(msg_type, 0) + 1
+        self.groups.apply(node_id, data)
+
+
+def replay_query(captured_query: str) -> str:
+    """세션 재개 토큰은 캡처한 서버에서만 유효하므로 빼고 나머지 쿼리만 유지합니다."""
+    params = [(k, v) for k, v in parse_qsl(captured_query) if k != "resume"]
+    return f"?{urlencode(params)}" if params else ""
+
+
+async def replay_node(node_id: str, events: List[CaptureRecord], args, t0: float, started: float,
+                      replayed: OutputSummary, stats: Dict):
+    async def wait_until(ts: float):
+        if args.speed > 0:
+            delay = started + (ts - t0) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    index = 0
+    while index < len(events):
+        # 연결 한 번(open ~ close)씩 재생. 캡처가 연결 도중부터 시작됐으면 첫 프레임 시각에 연결
+        query = events[index].data if events[index].kind == KIND_OPEN else ""
+        await wait_until(events[index].ts)
+        if events[index].kind == KIND_OPEN:
+            index += 1
+        try:
+            async with websockets.connect(f"{args.uri}{node_id}{replay_query(query)}", max_queue=None) as websocket:
+                stats["connections"] += 1
+
+                async def receiver():
+                    async for raw in websocket:
+                        replayed.add(node_id, raw)
+
+                receive_task = asyncio.create_task(receiver())
+                while index < len(events) and events[index].kind != KIND_OPEN:
+                    event = events[index]
+                    index += 1
+                    await wait_until(event.ts)
+                    if event.kind == KIND_CLOSE:
+                        break
+                    await websocket.send(event.data)
+                    stats["frames_sent"] += 1
+                await asyncio.sleep(args.drain)
+                receive_task.cancel()
+        except Exception as e:
+            stats["errors"] += 1
+            if args.verbose:
+                print(f"⚠️ [{node_id}] 재생 오류: {e}")
+            while index < len(events) and events[index].kind != KIND_OPEN:
+                index += 1
+
+
+def compare(captured: OutputSummary, replayed: OutputSummary) -> Dict:
+    by_type = {}
+    for msg_type in sorted(set(captured.by_type) | set(replayed.by_type)):
+        before, after = captured.by_type.get(msg_type, 0), replayed.by_type.get(msg_type, 0)
+        by_type[msg_type] = {"captured": before, "replayed": after,
+                             "diff_pct": round((after - before) * 100 / before, 1) if before else None}
+    nodes = set(captured.groups.groups) | set(replayed.groups.groups)
+    exact, jaccard_sum = 0, 0.0
+    for node_id in nodes:
+        a = captured.groups.groups.get(node_id, set())
+        b = replayed.groups.groups.get(node_id, set())
+        union = a | b
+        jaccard_sum += len(a & b) / len(union) if union else 1.0
+        exact += a == b
+    return {"messages_by_type": by_type,
+            "final_groups": {"nodes": len(nodes), "exact_match": exact,
+                             "mean_jaccard": round(jaccard_sum / len(nodes), 4) if nodes else None}}
+
+
+async def main(args):
+    records = load_records(args.captures)
+    if not records:
+        print("⚠️ 재생할 레코드가 없습니다.")
+        return
+    counts = {name: 0 for name in KIND_NAMES.values()}
+    captured = OutputSummary()
+    per_node: Dict[str, List[CaptureRecord]] = {}
+    for record in records:
+        kind_name = KIND_NAMES.get(record.kind, "unknown")
+        counts[kind_name] = counts.get(kind_name, 0) + 1
+        if record.kind == KIND_OUT:
+            captured.add(record.node_id, record.data)
+        elif record.kind in (KIND_OPEN, KIND_IN, KIND_CLOSE):
+            per_node.setdefault(record.node_id, []).append(record)
+    t0 = records[0].ts
+    span = records[-1].ts - t0
+    speed_label = f"{args.speed}×" if args.speed > 0 else "최대 속도"
+    print(f"🎬 {len(per_node)}대, {counts['in']}개 프레임, 캡처 길이 {span:.1f}초를 {speed_label}로 재생합니다...")
+
+    # 재생 대상 서버가 재생 트래픽을 다시 캡처하지 않게 함
+    server = spawn_server(args, unset_env=("CAPTURE_PATH",)) if args.spawn_server else None
+    try:
+        replayed = OutputSummary()
+        stats = {"connections": 0, "frames_sent": 0, "errors": 0}
+        started = time.perf_counter()
+        await asyncio.gather(*(replay_node(node_id, events, args, t0, started, replayed, stats)
+                               for node_id, events in per_node.items()))
+        elapsed = time.perf_counter() - started
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "captures": args.captures,
+        "records": counts,
+        "capture_span_s": round(span, 2),
+        "replay_elapsed_s": round(elapsed, 2),
+        "effective_speed": round(span / elapsed, 2) if elapsed else None,
+        "frames_per_s": round(stats["frames_sent"] / elapsed, 1) if elapsed else None,
+        **stats,
+        **compare(captured, replayed),
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"📄 결과를 {args.output} 에 저장했습니다.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a main.py traffic capture and compare outputs")
+    parser.add_argument("captures", nargs="+", help="CAPTURE_PATH 로 기록한 파일 (멀티 워커면 워커별 파일 전부)")
+    parser.add_argument("--uri", default="ws://localhost:8080/ws/", help="main.py 웹소켓 주소 (node_id 앞부분까지)")
+    parser.add_argument("--speed", type=float, default=1.0, help="재생 배속 (1=실제 속도, 0=최대 속도)")
+    parser.add_argument("--drain", type=float, default=2.0, help="연결 종료 전 응답을 기다리는 시간(초)")
+    parser.add_argument("--redis-url", help="--spawn-server 시 사용할 Redis")
+    parser.add_argument("--spawn-server", action="store_true", help="main.py 를 직접 띄워서 재생")
+    parser.add_argument("--backend", default="memory", choices=["memory", "redis"], help="--spawn-server 시 그룹핑 백엔드")
+    parser.add_argument("--port", type=int, default=8080, help="--spawn-server 시 서버 포트")
+    parser.add_argument("--server-startup", type=float, default=3.0, help="--spawn-server 후 대기 시간(초)")
+    parser.add_argument("--output", help="결과 JSON 저장 경로")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.spawn_server:
+        args.uri = f"ws://localhost:{args.port}/ws/"
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("\n재생을 중단합니다.")
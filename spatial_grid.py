@@ -0,0 +1,169 @@
+# spatial_grid.py (main.py 용 인메모리 그룹핑 백엔드)
+# - Redis 없이 단일 서버로 돌릴 때의 빠른 경로
+# - Redis GEO 백엔드와 같은 update_and_get_group 계약을 가지므로 테스트 대역으로도 사용
+import heapq
+import math
+from typing import Dict, List, Optional, Set, Tuple
+
+from geo_utils import EARTH_RADIUS_M, haversine_m
+
+METERS_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180
+
+
+class SpatialGrid:
+    """위경도 정사각 셀로 나눈 균일 격자. 갱신은 O(1), 반경 검색은 주변 셀만 확인합니다."""
+
+    def __init__(self, cell_size_m: float):
+        self.cell_deg = cell_size_m / METERS_PER_DEG_LAT
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.positions: Dict[str, Tuple[float, float]] = {}
+        self.node_cells: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self.positions
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def update(self, node_id: str, lat: float, lon: float):
+        cell = self._cell(lat, lon)
+        old_cell = self.node_cells.get(node_id)
+        if old_cell != cell:
+            if old_cell is not None:
+                self._discard(node_id, old_cell)
+            self.cells.setdefault(cell, set()).add(node_id)
+            self.node_cells[node_id] = cell
+        self.positions[node_id] = (lat, lon)
+
+    def remove(self, node_id: str):
+        cell = self.node_cells.pop(node_id, None)
+        if cell is not None:
+            self._discard(node_id, cell)
+        self.positions.pop(node_id, None)
+
+    def _discard(self, node_id: str, cell: Tuple[int, int]):
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(node_id)
+            if not members:
+                del self.cells[cell]
+
+    def search(self, lat: float, lon: float, radius_m: float) -> List[Tuple[str, Tuple[float, float]]]:
+        """(lat, lon) 으로부터 radius_m 이내의 (node_id, (lat, lon)) 목록을 반환합니다."""
+        row, col = self._cell(lat, lon)
+        row_span = int(math.ceil(radius_m / METERS_PER_DEG_LAT / self.cell_deg))
+        # 경도 방향 1도의 길이는 cos(lat) 만큼 줄어드므로 확인할 열 수를 늘림
+        cos_lat = max(math.cos(math.radians(min(89.0, abs(lat) + row_span * self.cell_deg))), 1e-6)
+        col_span = int(math.ceil(row_span / cos_lat))
+        found = []
+        for r in range(row - row_span, row + row_span + 1):
+            for c in range(col - col_span, col + col_span + 1):
+                for node_id in self.cells.get((r, c), ()):
+                    pos = self.positions[node_id]
+                    if haversine_m(lat, lon, pos[0], pos[1]) <= radius_m:
+                        found.append((node_id, pos))
+        return found
+
+
+class InMemoryGroupingBackend:
+    """SpatialGrid 위에 그룹 인접 집합, last_seen, 좌표 스냅샷 주기를 관리하는 단일 프로세스 백엔드."""
+
+    def __init__(self, radius_m: float):
+        self.radius_m = radius_m
+        self.grid = SpatialGrid(radius_m)
+        self.groups: Dict[str, Set[str]] = {}
+        self.last_seen: Dict[str, float] = {}
+        # (last_seen, node_id) 최소 힙. 갱신 때마다 새 항목을 넣고, last_seen 과 다른 옛 항목은 꺼낼 때 버림
+        self.seen_heap: List[Tuple[float, str]] = []
+        self.coords_at: Dict[str, float] = {}
+
+    def update_and_get_group(self, node_id: str, location: Tuple[float, float]) -> List[Dict]:
+        self.grid.update(node_id, location[0], location[1])
+        return [{"node_id": name, "location": pos}
+                for name, pos in self.grid.search(location[0], location[1], self.radius_m)]
+
+    def diff_group_membership(self, node_id: str, group_members: List[Dict]) -> Tuple[List[Dict], List[str]]:
+        current = {m["node_id"]: m["location"] for m in group_members if m["node_id"] != node_id}
+        previous = self.groups.setdefault(node_id, set())
+        joined = [{"node_id": other, "location": loc} for other, loc in current.items() if other not in previous]
+        left = [other for other in previous if other not in current]
+        for other in left:
+            previous.discard(other)
+            self.groups.get(other, set()).discard(node_id)
+        for member in joined:
+            previous.add(member["node_id"])
+            self.groups.setdefault(member["node_id"], set()).add(node_id)
+        return joined, left
+
+    def take_coords_slot(self, node_id: str, now: float, interval_s: float) -> bool:
+        """좌표 스냅샷을 보낼 차례면 True 를 반환하고 시각을 기록합니다."""
+        if now - self.coords_at.get(node_id, 0.0) < interval_s:
+            return False
+        self.coords_at[node_id] = now
+        return True
+
+    def touch(self, node_id: str, now: float):
+        self.last_seen[node_id] = now
+        heapq.heappush(self.seen_heap, (now, node_id))
+        if len(self.seen_heap) > 2 * len(self.last_seen) + 64:
+            # 옛 항목이 쌓이면 현재 last_seen 으로 다시 만들어 힙 크기를 차량 수에 비례하게 유지
+            self.seen_heap = [(seen, name) for name, seen in self.last_seen.items()]
+            heapq.heapify(self.seen_heap)
+
+    def remove(self, node_id: str) -> List[str]:
+        """노드를 모든 인덱스에서 지우고, 알려야 할 이전 이웃 목록을 반환합니다."""
+        neighbours = list(self.groups.pop(node_id, set()))
+        for other in neighbours:
+            self.groups.get(other, set()).discard(node_id)
+        self.grid.remove(node_id)
+        self.last_seen.pop(node_id, None)
+        self.coords_at.pop(node_id, None)
+        return neighbours
+
+    def expired(self, cutoff: float, limit: int) -> List[str]:
+        """last_seen 이 cutoff 이전인 노드를 오래된 순으로 최대 limit 개 반환합니다.
+        힙 앞쪽만 보므로 (옛 항목을 버리는 분할 상환 비용을 빼면) O(limit log n). 제거는 호출 측이 remove 로 합니다."""
+        stale: List[str] = []
+        taken: Set[Tuple[float, str]] = set()
+        while self.seen_heap and self.seen_heap[0][0] < cutoff and len(stale) < limit:
+            seen, node_id = heapq.heappop(self.seen_heap)
+            if self.last_seen.get(node_id) == seen and (seen, node_id) not in taken:
+                taken.add((seen, node_id))
+                stale.append(node_id)
+        # 호출 측이 건너뛴 노드(아직 연결 중 등)도 다음 sweep 에서 다시 보이도록 유효 항목은 되돌려 둠
+        for entry in taken:
+            heapq.heappush(self.seen_heap, entry)
+        return stale
+
+
+def compute_neighbours(positions: Dict[str, Tuple[float, float]], radius_m: float,
+                       leave_m: Optional[float] = None, previous: Optional[Dict[str, Set[str]]] = None,
+                       predicted: Optional[Dict[str, Tuple[float, float]]] = None) -> Dict[str, Set[str]]:
+    """전체 차량 위치로 격자를 한 번 만들고 각 차량의 이웃 집합을 한꺼번에 계산합니다 (틱 배치용).
+    leave_m/previous 를 주면 기존 이웃은 leave_m 까지 유지하고(히스테리시스),
+    predicted 를 주면 두 차량의 예측 위치가 radius_m 안일 때도 미리 합류시킵니다."""
+    leave_m = max(leave_m or radius_m, radius_m)
+    previous = previous or {}
+    predicted = predicted or {}
+    grid = SpatialGrid(leave_m)
+    for node_id, (lat, lon) in positions.items():
+        grid.update(node_id, lat, lon)
+    neighbours: Dict[str, Set[str]] = {}
+    for node_id, (lat, lon) in positions.items():
+        before = previous.get(node_id, ())
+        mine = predicted.get(node_id)
+        current = set()
+        for other, pos in grid.search(lat, lon, leave_m):
+            if other == node_id:
+                continue
+            if other in before or haversine_m(lat, lon, pos[0], pos[1]) <= radius_m:
+                current.add(other)
+            elif mine is not None and other in predicted:
+                theirs = predicted[other]
+                if haversine_m(mine[0], mine[1], theirs[0], theirs[1]) <= radius_m:
+                    current.add(other)
+        neighbours[node_id] = current
+    return neighbours
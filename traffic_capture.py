@@ -0,0 +1,73 @@
+# traffic_capture.py (main.py 웹소켓 트래픽 캡처 파일 형식)
+# - main.py 는 CAPTURE_PATH 가 설정되면 모든 수신/송신 프레임을 append-only 파일에 기록
+# - replay_capture.py 가 같은 모듈로 파일을 읽어 로컬 main.py 에 그대로 재생
+#
+# 레코드 = 헤더(struct "<dBBHI": 시각, 종류, 텍스트 여부, node_id 길이, 본문 길이) + node_id + 본문
+import os
+import struct
+import time
+from typing import Iterator, NamedTuple, Union
+
+RECORD_HEADER = struct.Struct("<dBBHI")
+
+KIND_OPEN = 0    # 연결 수락. 본문은 쿼리스트링 (예: "encoding=msgpack")
+KIND_IN = 1      # 차량 -> 서버 프레임
+KIND_OUT = 2     # 서버 -> 차량 프레임
+KIND_CLOSE = 3   # 연결 종료
+KIND_NAMES = {KIND_OPEN: "open", KIND_IN: "in", KIND_OUT: "out", KIND_CLOSE: "close"}
+
+
+class CaptureRecord(NamedTuple):
+    ts: float
+    kind: int
+    node_id: str
+    data: Union[str, bytes]
+
+
+class TrafficCapture:
+    """버퍼링된 append-only 기록기. 이벤트 루프에서 바로 호출하고, flush 는 주기적으로만 합니다."""
+
+    def __init__(self, path: str, buffer_bytes: int = 1 << 20):
+        self.path = path
+        self.file = open(path, "ab", buffering=buffer_bytes)
+        self.records = 0
+        self.bytes = 0
+
+    def record(self, kind: int, node_id: str, data: Union[str, bytes, None] = b""):
+        is_text = isinstance(data, str)
+        body = data.encode() if is_text else (data or b"")
+        name = node_id.encode()
+        self.file.write(RECORD_HEADER.pack(time.time(), kind, is_text, len(name), len(body)))
+        self.file.write(name)
+        self.file.write(body)
+        self.records += 1
+        self.bytes += RECORD_HEADER.size + len(name) + len(body)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    """캡처 파일을 순서대로 읽습니다. 기록 중 잘린 마지막 레코드는 무시합니다."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            ts, kind, is_text, name_len, body_len = RECORD_HEADER.unpack(header)
+            name = f.read(name_len)
+            body = f.read(body_len)
+            if len(name) < name_len or len(body) < body_len:
+                return
+            yield CaptureRecord(ts, kind, name.decode(), body.decode() if is_text else body)
+
+
+def capture_path_for_worker(path: str, worker_id: str, workers: int) -> str:
+    """멀티 워커면 워커마다 별도 파일에 기록합니다 (재생 시 여러 파일을 시각순으로 합침)."""
+    if workers <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker_id}{ext}"
@@ -1,4 +1,7 @@
 import argparse, time, json, requests, math, sys
+import heapq
+import itertools
+import threading
 import pyttsx3
 import re
 import socket
@@ -32,6 +35,90 @@ def speak(text_to_say: str):
         print(f"[TTS.speak] 말하기 오류: {e}", file=sys.stderr)
 
 
+# --- [비동기 클라이언트용 음성 워커] ---
+# speak() 는 runAndWait() 가 끝날 때까지 호출한 스레드를 막으므로 asyncio 루프(p2p_client.py)에서는
+# speak_async() 를 사용합니다. 전용 스레드가 엔진을 소유하고, 큐는 크기 제한 + 우선순위.
+PRIORITY_ALERT = 0
+PRIORITY_INFO = 1
+
+
+class SpeechWorker:
+    """전용 스레드에서 문장을 순서대로 재생합니다. say() 는 큐에 넣고 바로 반환.
+    큐가 가득 차면 우선순위가 가장 낮고 가장 늦게 들어온 문장을 버리고, 이미 대기 중인 같은 문장은 합칩니다."""
+
+    def __init__(self, maxsize: int = 8, rate: int = 160):
+        self.maxsize = maxsize
+        self.rate = rate
+        self.heap = []  # (priority, 순번, 문장)
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+        self.stats = {"queued": 0, "spoken": 0, "dropped": 0, "coalesced": 0}
+        self.thread = threading.Thread(target=self._run, name="tts-worker", daemon=True)
+        self.thread.start()
+
+    def say(self, text: str, priority: int = PRIORITY_INFO) -> bool:
+        with self.cond:
+            if any(item[2] == text for item in self.heap):
+                self.stats["coalesced"] += 1
+                return False
+            if len(self.heap) >= self.maxsize:
+                worst = max(self.heap)
+                if worst[0] <= priority:
+                    self.stats["dropped"] += 1
+                    return False
+                self.heap.remove(worst)
+                heapq.heapify(self.heap)
+                self.stats["dropped"] += 1
+            heapq.heappush(self.heap, (priority, next(self.order), text))
+            self.stats["queued"] += 1
+            self.cond.notify()
+        return True
+
+    def close(self):
+        with self.cond:
+            heapq.heappush(self.heap, (-1, next(self.order), None))
+            self.cond.notify()
+
+    def _run(self):
+        try:
+            # 엔진은 반드시 재생하는 스레드 *안에서* 초기화 (tts_worker 와 같은 이유)
+            engine = pyttsx3.init()
+            engine.setProperty("rate", self.rate)
+        except Exception as e:
+            print(f"[TTS_WORKER] TTS 엔진 초기화 실패: {e}", file=sys.stderr)
+            return
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                _, _, text = heapq.heappop(self.heap)
+            if text is None:
+                break
+            try:
+                engine.say(text)
+                engine.runAndWait()
+                self.stats["spoken"] += 1
+            except Exception as e:
+                print(f"[TTS_WORKER] 재생 중 오류: {e}", file=sys.stderr)
+
+
+_speech_worker = None
+
+
+def speak_async(text_to_say: str, priority: int = PRIORITY_INFO) -> bool:
+    """기본 SpeechWorker 에 문장을 넣고 바로 반환합니다 (첫 호출 시 워커 시작)."""
+    global _speech_worker
+    if _speech_worker is None:
+        _speech_worker = SpeechWorker()
+    return _speech_worker.say(text_to_say, priority)
+
+
+def speech_stats() -> dict:
+    if _speech_worker is None:
+        return {}
+    return {**_speech_worker.stats, "pending": len(_speech_worker.heap)}
+
+
 # --- [임포트용 끝] ---
 
 